@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import StudyAnalysis, ProbExcelSheets
+from .models import StudyAnalysis, ProbExcelSheets, SimulationResult
 
 
 admin.site.register(StudyAnalysis)
 admin.site.register(ProbExcelSheets)
+admin.site.register(SimulationResult)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CalcmainConfig(AppConfig):
     name = 'calcmain'
+
+    def ready(self):
+        from . import signals  # noqa: F401
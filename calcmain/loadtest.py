@@ -0,0 +1,250 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.core.files.base import ContentFile
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from io import BytesIO
+from urllib.parse import urlsplit
+from .models import ProbExcelSheets
+from . import pipeline, precompute
+import os
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+# Drives the wizard's URL sequence concurrently, either in-process through
+# Django's test client or against a running server, and collects per-endpoint
+# latencies. Everything it needs is generated locally.
+
+
+def _excel(df):
+    buffer = BytesIO()
+    writer = pd.ExcelWriter(buffer, engine="openpyxl")
+    df.to_excel(writer, index=False)
+    writer.save()
+    return buffer.getvalue()
+
+
+def synthetic_sheet(num_patients, rng):
+    """An upload sheet with 2-5 target lesions per patient, at most 2 lymph nodes."""
+    rows = []
+    for patient in range(1, num_patients + 1):
+        num_lesions = rng.randint(2, 6)
+        num_lymph = min(rng.randint(0, 3), num_lesions)
+        change = rng.uniform(-0.9, 0.9)
+        for lesion in range(num_lesions):
+            organ = "Lymph node" if lesion < num_lymph else rng.choice(["Lung", "Liver", "Bone", "Kidney"])
+            baseline = int(rng.randint(15 if lesion < num_lymph else 10, 60))
+            post = max(int(round(baseline * (1 + change + rng.uniform(-0.1, 0.1)))), 0)
+            rows.append([patient, organ, baseline, post])
+    main_df = pd.DataFrame(rows, columns=['ID', 'Organ', 'Lesion size at baseline (mm)', 'Lesion size at post-treatment (mm)'])
+    return _excel(main_df)
+
+
+def synthetic_probability_tables():
+    """Probability sheets of both observer models, as {sheets_name: xlsx bytes}.
+
+    Every status gets the same smooth curves of percent change: PR is likely
+    well below -30%, progression well above +20%, with a wider spread for
+    the inter-observer model.
+    """
+    change = np.arange(-99, 101)
+    statuses = {
+        "Multiple": ["%d%d" % (ns, nl) for ns in range(6) for nl in range(6) if ns + nl > 1],
+        "Singular": ["%d%d%d" % (ns, nl, size) for ns, nl in [(1, 0), (0, 1)] for size in range(1, 151)],
+    }
+    sheets = {}
+    for observer, spread in [("intra", 3.0), ("inter", 6.0)]:
+        curves = {
+            "PR": 1 / (1 + np.exp((change + 30) / spread)),
+            "Pro": 1 / (1 + np.exp(-(change - 20) / spread)),
+        }
+        for kind, curve in curves.items():
+            for lesions, columns in statuses.items():
+                table = pd.DataFrame(np.repeat(curve[:, None], len(columns), axis=1), columns=columns)
+                table.insert(0, "PercentChange", change)
+                sheets["%s_%s_%s" % (pipeline.OBSERVERS[observer], kind, lesions)] = _excel(table)
+    return sheets
+
+
+@contextmanager
+def test_environment():
+    """A throwaway database and MEDIA_ROOT, seeded with synthetic probability tables."""
+    directory = tempfile.mkdtemp(prefix="calcmain-loadtest-")
+    if connection.vendor == "sqlite":
+        # A file rather than shared-cache memory, so concurrent users do not lock each other's tables
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(directory, "db.sqlite3")
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with override_settings(MEDIA_ROOT=os.path.join(directory, "media")):
+            try:
+                for name, content in synthetic_probability_tables().items():
+                    ProbExcelSheets.objects.create(sheets_name=name, imported_sheet=ContentFile(content, name=name + ".xlsx"))
+                yield
+            finally:
+                # Precompute jobs of the uploads must not outlive the test database and MEDIA_ROOT
+                precompute.shutdown()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class ClientSession(object):
+    """In-process requests through Django's test client."""
+
+    def __init__(self):
+        self.client = Client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get("Location", "")
+
+    def upload(self, path, data, filename, content):
+        sheet = BytesIO(content)
+        sheet.name = filename
+        data = dict(data, imported_sheet=sheet)
+        response = self.client.post(path, data)
+        return response.status_code, response.get("Location", "")
+
+
+class HttpSession(object):
+    """Requests against a running server, e.g. gunicorn on localhost."""
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def get(self, path):
+        response = self.session.get(self.base_url + path, allow_redirects=False)
+        return response.status_code, response.headers.get("Location", "")
+
+    def upload(self, path, data, filename, content):
+        # Fetch the form first for the CSRF cookie and token
+        form = self.session.get(self.base_url + path)
+        match = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', form.text)
+        data = dict(data, csrfmiddlewaretoken=match.group(1) if match else "")
+        response = self.session.post(self.base_url + path, data=data, allow_redirects=False,
+                                     files={"imported_sheet": (filename, content)},
+                                     headers={"Referer": self.base_url + path})
+        return response.status_code, response.headers.get("Location", "")
+
+
+class LoadTest(object):
+
+    def __init__(self, users=4, iterations=1, patients=50, up_patients=2, observer="intra", adaptive=False,
+                 base_url=None, seed=0):
+        self.users = users
+        self.iterations = iterations
+        self.patients = patients
+        self.up_patients = up_patients
+        self.observer = observer
+        self.adaptive = adaptive
+        self.base_url = base_url
+        self.seed = seed
+        self.samples = OrderedDict()  # endpoint name -> list of (seconds, ok)
+        self.lock = threading.Lock()
+
+    def _record(self, name, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(name, []).append((seconds, ok))
+
+    def _timed(self, name, call, *args, **kwargs):
+        expected = kwargs.get("expected")
+        start = time.perf_counter()
+        try:
+            status, location = call(*args)
+        except Exception:
+            self._record(name, time.perf_counter() - start, False)
+            return None, ""
+        ok = status == expected if expected else status < 400
+        self._record(name, time.perf_counter() - start, ok)
+        return status, location
+
+    def _session(self):
+        return HttpSession(self.base_url) if self.base_url else ClientSession()
+
+    def run_user(self, user):
+        try:
+            self._run_user(user)
+        finally:
+            connection.close()
+
+    def _run_user(self, user):
+        rng = np.random.RandomState(self.seed + user)
+        session = self._session()
+        for iteration in range(self.iterations):
+            sheet = synthetic_sheet(self.patients, rng)
+            data = {
+                "study_name": "Load test %d-%d" % (user, iteration),
+                "treatment_name": "Synthetic",
+                "up_patients": self.up_patients,
+            }
+            status, location = self._timed("dataimport", session.upload, reverse("calcmain:dataimport"),
+                                            data, "loadtest.xlsx", sheet, expected=302)
+            if status != 302:
+                continue
+            pk = resolve(urlsplit(location).path).kwargs["pk"]
+
+            reassessment = "calcmain:data_reassessment1" if self.observer == "intra" else "calcmain:data_reassessment2"
+            final_result = reverse("calcmain:final_result", kwargs={"pk": pk})
+            if self.adaptive:
+                final_result += "?adaptive=1"
+            for name, path in [
+                ("data_confirm", reverse("calcmain:data_confirm", kwargs={"pk": pk})),
+                ("data_process", reverse("calcmain:data_process", kwargs={"pk": pk})),
+                ("data_process_table", reverse("calcmain:data_process_table", kwargs={"pk": pk}) + "?sort=3&order=desc"),
+                ("data_summary", reverse("calcmain:data_summary", kwargs={"pk": pk})),
+                (reassessment.split(":")[1], reverse(reassessment, kwargs={"pk": pk})),
+                ("final_result", final_result),
+                ("final_result (reload)", final_result),
+                ("export_delete", reverse("calcmain:export_delete", kwargs={"pk": pk})),
+            ]:
+                self._timed(name, session.get, path)
+
+    def run(self):
+        threads = [threading.Thread(target=self.run_user, args=(user,)) for user in range(self.users)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+        return self.report()
+
+    def report(self):
+        rows = []
+        for name, samples in self.samples.items():
+            seconds = np.array([s for s, ok in samples]) * 1000
+            errors = sum(1 for s, ok in samples if not ok)
+            p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+            rows.append({
+                "endpoint": name,
+                "requests": len(samples),
+                "p50_ms": p50,
+                "p95_ms": p95,
+                "p99_ms": p99,
+                "throughput": len(samples) / self.elapsed,
+                "error_rate": errors / float(len(samples)),
+            })
+        return rows
+
+
+def peak_rss_mb(pid=None):
+    """Peak resident set size of this process, or of `pid` via /proc."""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    with open("/proc/%d/status" % pid) as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024.0
+    return None
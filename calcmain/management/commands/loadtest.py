@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from calcmain import loadtest
+
+
+class Command(BaseCommand):
+    help = ("Run the full wizard flow with concurrent virtual users and report per-endpoint latency. "
+            "In-process runs use a throwaway test database and MEDIA_ROOT with synthetic probability "
+            "tables; with --url, studies are created on and deleted from that server.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=4, help="Concurrent virtual users.")
+        parser.add_argument("--iterations", type=int, default=1, help="Studies run by each user.")
+        parser.add_argument("--patients", type=int, default=50, help="Patients per synthetic sheet.")
+        parser.add_argument("--up-patients", type=int, default=2, help="UP patients per study.")
+        parser.add_argument("--observer", choices=["intra", "inter"], default="intra",
+                            help="Reassessment assumption to run.")
+        parser.add_argument("--adaptive", action="store_true", help="Request the adaptive final result.")
+        parser.add_argument("--url", default=None,
+                            help="Base URL of a running server, e.g. http://127.0.0.1:8000. "
+                                 "Uses Django's test client in-process when omitted.")
+        parser.add_argument("--pid", type=int, default=None,
+                            help="Server process to report the peak RSS of (with --url).")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic sheets.")
+
+    def handle(self, *args, **options):
+        test = loadtest.LoadTest(users=options["users"], iterations=options["iterations"],
+                                 patients=options["patients"], up_patients=options["up_patients"],
+                                 observer=options["observer"], adaptive=options["adaptive"],
+                                 base_url=options["url"], seed=options["seed"])
+        if options["url"] is None:
+            with loadtest.test_environment():
+                rows = test.run()
+        else:
+            rows = test.run()
+
+        self.stdout.write("%-24s %8s %10s %10s %10s %10s %7s" % (
+            "endpoint", "requests", "p50 ms", "p95 ms", "p99 ms", "req/s", "errors"))
+        for row in rows:
+            self.stdout.write("%-24s %8d %10.1f %10.1f %10.1f %10.2f %6.1f%%" % (
+                row["endpoint"], row["requests"], row["p50_ms"], row["p95_ms"], row["p99_ms"],
+                row["throughput"], row["error_rate"] * 100))
+
+        total = sum(row["requests"] for row in rows)
+        self.stdout.write("Total: %d requests in %.1f s (%.2f req/s)" % (total, test.elapsed, total / test.elapsed))
+        if options["url"] is None:
+            self.stdout.write("Peak RSS: %.1f MB" % loadtest.peak_rss_mb())
+        elif options["pid"] is not None:
+            self.stdout.write("Peak RSS of server process %d: %.1f MB" % (options["pid"], loadtest.peak_rss_mb(options["pid"])))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from calcmain import retention
+
+
+class Command(BaseCommand):
+    help = "Delete abandoned studies, their uploaded sheets and orphaned upload files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None,
+                            help="Delete studies not accessed for this many days (CALCMAIN_RETENTION_DAYS).")
+        parser.add_argument("--budget-mb", type=float, default=None,
+                            help="Storage budget for the remaining studies (CALCMAIN_STORAGE_BUDGET_MB).")
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="Studies deleted per transaction (CALCMAIN_RETENTION_BATCH).")
+        parser.add_argument("--pause", type=float, default=0.0,
+                            help="Seconds to sleep between batches.")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report what would be deleted without deleting it.")
+        parser.add_argument("--vacuum", action="store_true",
+                            help="Compact the sqlite database afterwards.")
+
+    def handle(self, *args, **options):
+        report = retention.purge(days=options["days"], budget_mb=options["budget_mb"],
+                                 batch_size=options["batch_size"], dry_run=options["dry_run"],
+                                 pause=options["pause"])
+        if options["vacuum"] and not options["dry_run"]:
+            retention.vacuum()
+        prefix = "Would delete " if options["dry_run"] else "Deleted "
+        self.stdout.write(prefix + str(report))
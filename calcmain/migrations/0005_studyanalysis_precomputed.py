@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import picklefield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calcmain', '0004_studyanalysis_sorted_df'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studyanalysis',
+            name='upload_digest',
+            field=models.CharField(blank=True, default='', editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='studyanalysis',
+            name='precomputed',
+            field=picklefield.fields.PickledObjectField(default=dict, editable=False),
+        ),
+    ]
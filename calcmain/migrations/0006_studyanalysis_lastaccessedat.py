@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def backfill_last_accessed(apps, schema_editor):
+    # Existing studies were last seen no later than we know of, not today
+    StudyAnalysis = apps.get_model('calcmain', 'StudyAnalysis')
+    StudyAnalysis.objects.update(lastAccessedAt=F('createdAt'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calcmain', '0005_studyanalysis_precomputed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studyanalysis',
+            name='lastAccessedAt',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_last_accessed, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import calcmain.models
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import picklefield.fields
+
+
+def assign_seeds(apps, schema_editor):
+    # The field default is evaluated once for the existing rows
+    StudyAnalysis = apps.get_model('calcmain', 'StudyAnalysis')
+    for pk in StudyAnalysis.objects.values_list('pk', flat=True):
+        StudyAnalysis.objects.filter(pk=pk).update(simulation_seed=calcmain.models.new_seed())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calcmain', '0006_studyanalysis_lastaccessedat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studyanalysis',
+            name='reassessed_observer',
+            field=models.CharField(blank=True, default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='studyanalysis',
+            name='simulation_seed',
+            field=models.IntegerField(default=calcmain.models.new_seed),
+        ),
+        migrations.RunPython(assign_seeds, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='SimulationResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('observer', models.CharField(max_length=20)),
+                ('version', models.CharField(max_length=40)),
+                ('trials', models.IntegerField()),
+                ('seed', models.IntegerField()),
+                ('precision', models.FloatField(default=0)),
+                ('pr_rates', picklefield.fields.PickledObjectField(editable=False)),
+                ('pro_rates', picklefield.fields.PickledObjectField(editable=False)),
+                ('error', models.FloatField(blank=True, null=True)),
+                ('createdAt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simulation_results', to='calcmain.StudyAnalysis')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='simulationresult',
+            unique_together=set([('study', 'observer', 'version', 'trials', 'seed', 'precision')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import picklefield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calcmain', '0007_simulationresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studyanalysis',
+            name='stage_versions',
+            field=picklefield.fields.PickledObjectField(default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import picklefield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calcmain', '0008_studyanalysis_stage_versions'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='studyanalysis',
+            name='reassessed_df',
+        ),
+        migrations.AddField(
+            model_name='studyanalysis',
+            name='reassessed_dfs',
+            field=picklefield.fields.PickledObjectField(default=dict, editable=False),
+        ),
+    ]
@@ -1,6 +1,11 @@
 from django.db import models
 from django.utils import timezone
 from picklefield.fields import PickledObjectField
+import random
+
+
+def new_seed():
+    return random.randint(0, 2 ** 31 - 1)
 
 
 class StudyAnalysis(models.Model):
@@ -10,8 +15,14 @@ class StudyAnalysis(models.Model):
     up_patients = models.IntegerField()
     processed_df = PickledObjectField(default="None")
     sorted_df = PickledObjectField(default="None")
-    reassessed_df = PickledObjectField(default="None")
+    reassessed_dfs = PickledObjectField(default=dict)  # observer model -> reassessed dataframe
+    reassessed_observer = models.CharField(max_length=20, blank=True, default="", editable=False)
+    upload_digest = models.CharField(max_length=40, blank=True, default="", editable=False)
+    precomputed = PickledObjectField(default=dict)
+    stage_versions = PickledObjectField(default=dict)
     createdAt = models.DateTimeField(default=timezone.now)
+    lastAccessedAt = models.DateTimeField(default=timezone.now, db_index=True)
+    simulation_seed = models.IntegerField(default=new_seed)
 
     def __str__(self):
         return self.study_name
@@ -23,3 +34,23 @@ class ProbExcelSheets(models.Model):
 
     def __str__(self):
         return self.sheets_name
+
+
+class SimulationResult(models.Model):
+    # Final-result distributions, memoized per simulation input
+    study = models.ForeignKey(StudyAnalysis, on_delete=models.CASCADE, related_name="simulation_results")
+    observer = models.CharField(max_length=20)
+    version = models.CharField(max_length=40)
+    trials = models.IntegerField()
+    seed = models.IntegerField()
+    precision = models.FloatField(default=0)  # 0 for a fixed number of trials
+    pr_rates = PickledObjectField()
+    pro_rates = PickledObjectField()
+    error = models.FloatField(null=True, blank=True)
+    createdAt = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ("study", "observer", "version", "trials", "seed", "precision")
+
+    def __str__(self):
+        return "%s (%s, %d trials)" % (self.study, self.observer, self.trials)
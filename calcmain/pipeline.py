@@ -0,0 +1,250 @@
+from .models import ProbExcelSheets
+import re
+import math
+import pandas as pd
+import numpy as np
+
+
+# Observer models and the names of their probability excel sheets
+OBSERVERS = {
+    "intra": "Intra",
+    "inter": "Inter",
+}
+
+# Parsed probability tables, keyed by (sheets_name, file name)
+_table_cache = {}
+
+
+def read_sheet(study):
+    return pd.read_excel(study.imported_sheet, sheetname=0)
+
+
+def process_sheet(main_df):
+    main_df = main_df.copy()
+
+    # Change column names and change uppercase characters(organ) into lowercase
+    main_df.columns = ['ID', 'Organ', 'Lesion size at baseline (mm)', 'Lesion size at post-treatment (mm)']
+    main_df["Organ"] = main_df["Organ"].str.lower()
+
+    # Generate a dataframe for processing the data
+    process_df = pd.DataFrame({'Patient ID': list(set([int(i) for i in main_df.ID]))})
+    process_df.loc[:, "Number of solid organ tumors"] = 0
+    process_df.loc[:, "Number of lymph nodes"] = 0
+    process_df.loc[:, "Tumor burden at baseline (mm)"] = 0  # Sum of all lesion size at baseline per patient(ID)
+    process_df.loc[:, "Tumor burden at post-treatment (mm)"] = 0 # Sum of all lesion size at post-treatment per patient(ID)
+    process_df.loc[:, "Lesion size at baseline (mm)"] = np.nan # For checking patients who have only one lesion (Solid or Lymph)
+    process_df.loc[:, "Percentage change (%)"] = 0
+
+    # Check records and update cells
+    for record in range(len(main_df.index)):
+        record_id = main_df.iloc[:, 0][record]
+        lesion_name = main_df.iloc[:, 1][record]
+        input_id = record_id - 1
+
+        if re.match("lymph*", lesion_name):
+            process_df.loc[input_id, "Number of lymph nodes"] += 1
+        else:
+            process_df.loc[input_id, "Number of solid organ tumors"] += 1
+        process_df.loc[input_id, "Tumor burden at baseline (mm)"] += main_df.iloc[:, 2][record]
+        process_df.loc[input_id, "Tumor burden at post-treatment (mm)"] += main_df.iloc[:, 3][record]
+
+    process_df.loc[:, "Number of solid organ tumors"] = process_df.loc[:, "Number of solid organ tumors"].astype(int)
+    process_df.loc[:, "Number of lymph nodes"] = process_df.loc[:, "Number of lymph nodes"].astype(int)
+    process_df.loc[:, "Tumor burden at baseline (mm)"] = process_df.loc[:, "Tumor burden at baseline (mm)"].astype(int)
+    process_df.loc[:, "Tumor burden at post-treatment (mm)"] = process_df.loc[:, "Tumor burden at post-treatment (mm)"].astype(int)
+
+    # Check processed dataframe and update cells
+    for record in range(len(process_df.index)):
+        process_df.loc[record, 'Percentage change (%)'] = math.floor((process_df.loc[record, "Tumor burden at post-treatment (mm)"] - process_df.loc[record, "Tumor burden at baseline (mm)"]) / process_df.loc[record, "Tumor burden at baseline (mm)"] * 100)
+        if process_df.loc[record, 'Percentage change (%)'] == -100:
+            process_df.loc[record, 'Percentage change (%)'] = -99
+        if process_df.loc[record, "Number of lymph nodes"] + process_df.loc[record, "Number of solid organ tumors"] == 1:
+            process_df.loc[record, "Lesion size at baseline (mm)"] = int(main_df.loc[main_df['ID'] == record + 1]['Lesion size at baseline (mm)'])
+
+    return process_df
+
+
+def summarize(processed_df):
+    # Waterfall data : percentage changes sorted in descending order
+    new_data = {'Index': [i + 1 for i in range(len(processed_df.index))],
+               'Percentage change (%)': sorted(processed_df.loc[:, "Percentage change (%)"], reverse=True)}
+    return pd.DataFrame(new_data)
+
+
+def load_probability_tables(observer):
+    prefix = OBSERVERS[observer]
+    tables = {}
+    for kind in ("PR_Multiple", "PR_Singular", "Pro_Multiple", "Pro_Singular"):
+        sheet = ProbExcelSheets.objects.get(sheets_name="%s_%s" % (prefix, kind))
+        key = (sheet.sheets_name, sheet.imported_sheet.name)
+        if key not in _table_cache:
+            _table_cache[key] = _change_index(pd.read_excel(sheet.imported_sheet, sheetname=0))
+        tables[kind] = _table_cache[key]
+    return tables
+
+
+def tables_version(observer):
+    # Changes whenever one of the observer's probability sheets is replaced
+    prefix = OBSERVERS[observer]
+    sheets = (ProbExcelSheets.objects.filter(sheets_name__startswith=prefix + "_")
+              .order_by("sheets_name").values_list("sheets_name", "imported_sheet"))
+    return ";".join("%s=%s" % sheet for sheet in sheets)
+
+
+# Change the index of probability dataframe
+def _change_index(pd_input):
+    pd_input.loc[:, 'PercentChange'] = np.round(pd_input.loc[:, 'PercentChange'])
+    pd_input.loc[:, 'PercentChange'] = pd_input.loc[:, 'PercentChange'].astype(int)
+    pd_input = pd_input.set_index(['PercentChange'])
+    pd_input.columns = pd_input.columns.astype(str)
+    return pd_input
+
+
+def reassess(processed_df, tables):
+    PR_Multiple = tables["PR_Multiple"]
+    PR_Singular = tables["PR_Singular"]
+    Pro_Multiple = tables["Pro_Multiple"]
+    Pro_Singular = tables["Pro_Singular"]
+
+    # 1) Prepare the new dataframe about reassessment result (PartialResponse, Progression)
+    processed_df = processed_df[['Patient ID', 'Number of solid organ tumors', 'Number of lymph nodes', 'Lesion size at baseline (mm)', 'Percentage change (%)']].copy()
+    processed_df.columns = ['ID', 'NS', 'NL', 'LS', 'PC']
+
+    processed_df.loc[:, 'NS'] = processed_df.loc[:, 'NS'].astype(str)
+    processed_df.loc[:, 'NL'] = processed_df.loc[:, 'NL'].astype(str)
+    processed_df.loc[:, 'LS'] = processed_df.loc[:, 'LS'].astype(str)
+
+    # 2) Setting the serial number to each record
+    for record in range(len(processed_df.index)):
+        if processed_df.loc[record, 'LS'] != 'nan':
+            processed_df.loc[record, 'old_status'] = processed_df.loc[record, 'NS'] + processed_df.loc[record, 'NL'] + str(int(float(processed_df.loc[record, 'LS'])))
+        else:
+            processed_df.loc[record, 'old_status'] = processed_df.loc[record, 'NS'] + processed_df.loc[record, 'NL']
+
+    # 3) Making [percent change] exceeding 100 to 100
+    for record in range(len(processed_df.index)):
+        if processed_df.loc[record, 'PC'] > 100:
+            processed_df.loc[record, 'PC'] = 100
+
+    # 4) Delete [# of Solid tumor & Lymph node] columns and make new columns
+    processed_df = processed_df.drop(processed_df.columns[[1, 2]], axis=1)
+    processed_df.loc[:, 'new_PR'] = processed_df.loc[:, 'new_PRO'] = 0
+
+    # 5) Match the records' serial numbers to the probability-df's data
+    for record in range(len(processed_df.index)):
+        if processed_df.loc[record, 'LS'] == 'nan':  # multiple
+            processed_df.loc[record, 'new_PR'] = PR_Multiple.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
+            processed_df.loc[record, 'new_PRO'] = Pro_Multiple.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
+        else:  # singular
+            processed_df.loc[record, 'new_PR'] = PR_Singular.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
+            processed_df.loc[record, 'new_PRO'] = Pro_Singular.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
+
+    return processed_df
+
+
+# Long-format sheets have a timepoint column after the organ:
+# ID, Organ, Timepoint, Lesion size at baseline (mm), Lesion size at the timepoint (mm)
+LONGITUDINAL_COLUMNS = ['ID', 'Organ', 'Timepoint', 'Lesion size at baseline (mm)', 'Lesion size at post-treatment (mm)']
+
+
+def is_longitudinal(main_df):
+    # Five columns alone are not enough, the third one must hold the timepoints
+    return (len(main_df.columns) == len(LONGITUDINAL_COLUMNS)
+            and "time" in str(main_df.columns[2]).lower())
+
+
+def process_longitudinal(main_df):
+    """Per-patient, per-timepoint burdens and percent changes in one grouped pass."""
+    main_df = main_df.copy()
+    main_df.columns = LONGITUDINAL_COLUMNS
+    main_df["ID"] = main_df["ID"].astype(int)
+    lymph = main_df["Organ"].str.lower().str.startswith("lymp").astype(int)  # as re.match("lymph*")
+    main_df["Number of lymph nodes"] = lymph
+    main_df["Number of solid organ tumors"] = 1 - lymph
+
+    grouped = main_df.groupby(["ID", "Timepoint"], sort=True)
+    process_df = grouped[["Number of solid organ tumors", "Number of lymph nodes",
+                          "Lesion size at baseline (mm)", "Lesion size at post-treatment (mm)"]].sum().reset_index()
+    process_df.columns = ['Patient ID', 'Timepoint', 'Number of solid organ tumors', 'Number of lymph nodes',
+                          'Tumor burden at baseline (mm)', 'Tumor burden at post-treatment (mm)']
+    for column in process_df.columns[2:]:
+        process_df[column] = process_df[column].astype(int)
+
+    baseline = process_df['Tumor burden at baseline (mm)']
+    if (baseline == 0).any():
+        rows = process_df.loc[baseline == 0, ['Patient ID', 'Timepoint']].values.tolist()
+        raise ValueError("Tumor burden at baseline is 0 for (patient, timepoint) %s" % rows)
+    change = np.floor((process_df['Tumor burden at post-treatment (mm)'] - baseline) / baseline * 100)
+    process_df['Percentage change (%)'] = change.replace(-100, -99).astype(int)
+
+    # For patients with only one lesion the baseline burden is that lesion's size
+    single = process_df['Number of solid organ tumors'] + process_df['Number of lymph nodes'] == 1
+    process_df['Lesion size at baseline (mm)'] = baseline.where(single)
+    return process_df
+
+
+def _lookup(table, percent_change, status):
+    values = table.stack().reindex(pd.MultiIndex.from_arrays([percent_change, status])).values
+    missing = np.isnan(values)
+    if missing.any():
+        raise KeyError(sorted(set(zip(percent_change[missing], status[missing]))))
+    return values
+
+
+def reassess_longitudinal(process_df, tables):
+    """Reassessed probabilities of every row with vectorized table lookups."""
+    number = (process_df['Number of solid organ tumors'].astype(str) + process_df['Number of lymph nodes'].astype(str)).values
+    single = process_df['Lesion size at baseline (mm)'].notnull().values
+    lesion_size = process_df['Lesion size at baseline (mm)'].fillna(0).astype(int).astype(str).values
+    status = np.where(single, np.char.add(number.astype(str), lesion_size.astype(str)), number).astype(str)
+    percent_change = np.minimum(process_df['Percentage change (%)'].values, 100)
+
+    reassessed_df = process_df[['Patient ID', 'Timepoint', 'Lesion size at baseline (mm)', 'Percentage change (%)']].copy()
+    reassessed_df.columns = ['ID', 'Timepoint', 'LS', 'PC']
+    reassessed_df['PC'] = percent_change
+    reassessed_df['old_status'] = status
+    reassessed_df['new_PR'] = reassessed_df['new_PRO'] = 0.0
+
+    for kind, rows in (("Multiple", ~single), ("Singular", single)):
+        if rows.any():
+            reassessed_df.loc[rows, 'new_PR'] = _lookup(tables["PR_" + kind], percent_change[rows], status[rows])
+            reassessed_df.loc[rows, 'new_PRO'] = _lookup(tables["Pro_" + kind], percent_change[rows], status[rows])
+    return reassessed_df
+
+
+def _natural_key(timepoint):
+    # Numbers inside labels compare by value: "Week 2" comes before "Week 10"
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", str(timepoint))]
+
+
+def trajectories(reassessed_df, up_patients):
+    """Observed and expected reassessed response rates at every timepoint, in percents.
+
+    Numeric timepoints are ordered by value, labels such as "Week 10" by the
+    numbers they contain.
+
+    UP patients count at every timepoint as progression, with probability 1
+    of progression and 0 of partial response at reassessment.
+    """
+    frame = pd.DataFrame({
+        'Timepoint': reassessed_df['Timepoint'].values,
+        'PR': (reassessed_df['PC'] <= -30).values,
+        'PRO': (reassessed_df['PC'] >= 20).values,
+        'new_PR': reassessed_df['new_PR'].values,
+        'new_PRO': reassessed_df['new_PRO'].values,
+    })
+    grouped = frame.groupby('Timepoint', sort=False)
+    sums = grouped[['PR', 'PRO', 'new_PR', 'new_PRO']].sum()
+    order = sorted(sums.index, key=None if frame['Timepoint'].dtype.kind in "iuf" else _natural_key)
+    sums = sums.loc[order]
+    total = grouped.size().loc[order] + up_patients
+
+    trajectory_df = pd.DataFrame({
+        'Timepoint': sums.index,
+        'Number of patients': total.values,
+        'Observed ORR (%)': (sums['PR'] / total * 100).round(2).values,
+        'Observed progression rate (%)': ((sums['PRO'] + up_patients) / total * 100).round(2).values,
+        'Expected ORR at reassessment (%)': (sums['new_PR'] / total * 100).round(2).values,
+        'Expected progression rate at reassessment (%)': ((sums['new_PRO'] + up_patients) / total * 100).round(2).values,
+    })
+    return trajectory_df
@@ -0,0 +1,203 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection, transaction
+from .models import StudyAnalysis, ProbExcelSheets
+from . import pipeline
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Speculative results of the wizard's pipeline are computed as soon as an upload
+# is saved and stored in StudyAnalysis.precomputed, tagged with the upload digest
+# they were computed from. Each result is stored as soon as it is ready, so a
+# view only ever waits for the one it needs. A changed or deleted upload cancels
+# the job, and results of a stale digest are thrown away.
+
+_executor = None
+_futures = {}  # study pk -> _Job
+_lock = threading.Lock()
+
+
+class _Job(object):
+    """A scheduled precomputation and the names of the results it stored so far."""
+
+    def __init__(self, digest):
+        self.digest = digest
+        self.future = None
+        self.stored = set()
+        self.discarded = set()  # stored in their own fields by the views meanwhile
+        self.condition = threading.Condition()
+
+    def store(self, pk, results, name):
+        with self.condition:
+            kept = {key: value for key, value in results.items() if key not in self.discarded}
+            # Conditional update: a deleted or re-uploaded study is left untouched
+            StudyAnalysis.objects.filter(pk=pk, upload_digest=self.digest).update(precomputed=kept)
+            self.stored.add(name)
+            self.condition.notify_all()
+
+    def finished(self, future):
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait(self, name, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: name in self.stored or self.future.done(), timeout)
+
+
+def enabled():
+    return getattr(settings, "CALCMAIN_PRECOMPUTE", True)
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, "CALCMAIN_PRECOMPUTE_WORKERS", 2))
+        return _executor
+
+
+def shutdown():
+    """Cancel queued jobs and wait for running ones, e.g. before a test database goes away."""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+        jobs = list(_futures.values())
+        _futures.clear()
+    for job in jobs:
+        job.future.cancel()
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def upload_digest(study):
+    key = "%s:%s" % (study.imported_sheet.name, study.up_patients)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def schedule(study):
+    digest = upload_digest(study)
+    cancel(study.pk)
+    if not enabled():
+        return
+    # Only start once the row is committed so the worker can see it
+    transaction.on_commit(lambda: _submit(study.pk, digest))
+
+
+def _submit(pk, digest):
+    job = _Job(digest)
+    job.future = _get_executor().submit(_run, pk, job)
+    with _lock:
+        _futures[pk] = job
+    job.future.add_done_callback(job.finished)
+    job.future.add_done_callback(lambda f: _forget(pk, job))
+
+
+def _forget(pk, job):
+    with _lock:
+        if _futures.get(pk) is job:
+            del _futures[pk]
+
+
+def cancel(pk):
+    with _lock:
+        job = _futures.pop(pk, None)
+    if job is not None:
+        job.future.cancel()
+
+
+def _is_current(pk, digest):
+    return StudyAnalysis.objects.filter(pk=pk, upload_digest=digest).exists()
+
+
+def _run(pk, job):
+    try:
+        if not _is_current(pk, job.digest):
+            return
+        study = StudyAnalysis.objects.get(pk=pk)
+        results = {"digest": job.digest}
+        main_df = pipeline.read_sheet(study)
+        if pipeline.is_longitudinal(main_df):
+            results["longitudinal_df"] = pipeline.process_longitudinal(main_df)
+            job.store(pk, results, "longitudinal_df")
+        else:
+            results["processed_df"] = pipeline.process_sheet(main_df)
+            job.store(pk, results, "processed_df")
+            results["sorted_df"] = pipeline.summarize(results["processed_df"])
+            job.store(pk, results, "sorted_df")
+        for observer in pipeline.OBSERVERS:
+            if not _is_current(pk, job.digest):
+                return
+            try:
+                results["tables_" + observer] = pipeline.tables_version(observer)
+                tables = pipeline.load_probability_tables(observer)
+            except ProbExcelSheets.DoesNotExist:
+                continue
+            if "longitudinal_df" in results:
+                name = "reassessed_longitudinal_" + observer
+                results[name] = pipeline.reassess_longitudinal(results["longitudinal_df"], tables)
+            else:
+                name = "reassessed_" + observer
+                results[name] = pipeline.reassess(results["processed_df"], tables)
+            job.store(pk, results, name)
+    except Exception:
+        logger.exception("Precomputation failed for study %s", pk)
+    finally:
+        connection.close()
+
+
+def _current_job(study):
+    with _lock:
+        job = _futures.get(study.pk)
+    return job if job is not None and job.digest == study.upload_digest else None
+
+
+def fetch(study, name, observer=None, timeout=None):
+    """Return a precomputed result for the study's current upload, or None.
+
+    Results of an `observer` model are only returned if its probability
+    tables did not change since they were computed.
+    """
+    digest = study.upload_digest
+    if not digest:
+        return None
+    job = _current_job(study)
+    if job is not None:
+        if job.future.running():
+            # Wait for this result only, not for the rest of the job
+            if not job.wait(name, getattr(settings, "CALCMAIN_PRECOMPUTE_WAIT", 30) if timeout is None else timeout):
+                return None
+        elif not job.future.done():
+            # Still queued behind other uploads, computing inline is quicker
+            cancel(study.pk)
+            return None
+        study.precomputed = StudyAnalysis.objects.only("precomputed").get(pk=study.pk).precomputed
+    results = study.precomputed
+    if not isinstance(results, dict) or results.get("digest") != digest:
+        return None
+    if observer is not None and results.get("tables_" + observer) != pipeline.tables_version(observer):
+        return None
+    return results.get(name)
+
+
+def discard(study, name):
+    """Drop a precomputed result once it is stored in its own field."""
+    job = _current_job(study)
+    if job is None:
+        results = study.precomputed
+        if not isinstance(results, dict) or name not in results:
+            return
+        del results[name]
+        StudyAnalysis.objects.filter(pk=study.pk, upload_digest=results.get("digest")).update(precomputed=results)
+        return
+
+    # The job rewrites the field with every result, keep it from restoring this one
+    with job.condition:
+        job.discarded.add(name)
+        results = StudyAnalysis.objects.only("precomputed").get(pk=study.pk).precomputed
+        if isinstance(results, dict) and name in results:
+            del results[name]
+            StudyAnalysis.objects.filter(pk=study.pk, upload_digest=job.digest).update(precomputed=results)
+        study.precomputed = results
@@ -0,0 +1,154 @@
+from django.conf import settings
+from django.utils import timezone
+from functools import wraps
+import cProfile
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+
+# Staff can profile a single request with ?_profile=1 (or the X-Calcmain-Profile
+# header). ?_profile=mem also records a tracemalloc snapshot. The profile is
+# saved under CALCMAIN_PROFILE_ROOT and listed on the profiles page. Only the
+# latest CALCMAIN_PROFILE_KEEP profiles are kept.
+
+PROFILE_PARAM = "_profile"
+PROFILE_HEADER = "HTTP_X_CALCMAIN_PROFILE"
+PROFILE_NAME = re.compile(r"^(?P<time>\d{8}-\d{6}-\d{6})-(?P<view>\w+)-(?P<pk>\w+)\.prof$")
+
+# tracemalloc is process-wide: one request traces at a time, others get time profiles only
+_tracing_lock = threading.Lock()
+
+
+def profile_root():
+    return getattr(settings, "CALCMAIN_PROFILE_ROOT", os.path.join(settings.BASE_DIR, "profiles"))
+
+
+def _requested(request):
+    mode = request.GET.get(PROFILE_PARAM) or request.META.get(PROFILE_HEADER)
+    if not mode or mode == "0" or not request.user.is_staff:
+        return None
+    return mode
+
+
+def _tag(request, kwargs):
+    # The study pk, or the compared studies' pks joined by "_" for compare
+    if "pk" in kwargs:
+        return kwargs["pk"]
+    studies = re.sub(r"\W+", "_", request.GET.get("studies", "")).strip("_")[:64]
+    return studies or "none"
+
+
+def profiled(view):
+    """Profile the view when a staff user asks for it.
+
+    Returns the view unchanged when CALCMAIN_PROFILING is off, so there is
+    no cost at all, and costs a dict lookup per request otherwise.
+    """
+    if not getattr(settings, "CALCMAIN_PROFILING", True):
+        return view
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        mode = _requested(request)
+        if mode is None:
+            return view(request, *args, **kwargs)
+
+        track_memory = mode == "mem" and _tracing_lock.acquire(False)
+        if track_memory and tracemalloc.is_tracing():
+            # Started outside of this module (PYTHONTRACEMALLOC), leave it alone
+            _tracing_lock.release()
+            track_memory = False
+        if track_memory:
+            tracemalloc.start()
+        profile = cProfile.Profile()
+        try:
+            response = profile.runcall(view, request, *args, **kwargs)
+        finally:
+            snapshot = None
+            if track_memory:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                _tracing_lock.release()
+            _save(view.__name__, _tag(request, kwargs), profile, snapshot)
+        return response
+    return wrapper
+
+
+def _save(view_name, pk, profile, snapshot):
+    root = profile_root()
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    base = os.path.join(root, "%s-%s-%s" % (timezone.now().strftime("%Y%m%d-%H%M%S-%f"), view_name, pk))
+    profile.dump_stats(base + ".prof")
+    if snapshot is not None:
+        snapshot.dump(base + ".snapshot")
+    _prune(root, getattr(settings, "CALCMAIN_PROFILE_KEEP", 200))
+
+
+def _prune(root, keep):
+    # Timestamped names sort oldest first
+    names = sorted(filename[:-len(".prof")] for filename in os.listdir(root) if PROFILE_NAME.match(filename))
+    for name in names[:max(len(names) - keep, 0)]:
+        for extension in (".prof", ".snapshot"):
+            try:
+                os.remove(os.path.join(root, name + extension))
+            except OSError:
+                pass
+
+
+def recent_profiles(limit=50):
+    root = profile_root()
+    if not os.path.isdir(root):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(root), reverse=True):
+        match = PROFILE_NAME.match(filename)
+        if match is None:
+            continue
+        name = filename[:-len(".prof")]
+        profiles.append({
+            "name": name,
+            "time": match.group("time"),
+            "view": match.group("view"),
+            "pk": match.group("pk"),
+            "has_snapshot": os.path.exists(os.path.join(root, name + ".snapshot")),
+        })
+        if len(profiles) >= limit:
+            break
+    return profiles
+
+
+def _path(name, extension):
+    # Names come from the query string, only accept ones we wrote
+    if not PROFILE_NAME.match(name + ".prof"):
+        raise ValueError(name)
+    path = os.path.join(profile_root(), name + extension)
+    if not os.path.exists(path):
+        raise ValueError(name)
+    return path
+
+
+def top_functions(name, limit=30):
+    stats = pstats.Stats(_path(name, ".prof"))
+    rows = []
+    for (filename, line, function), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({
+            "function": "%s:%d(%s)" % (filename, line, function),
+            "calls": nc,
+            "tottime": tt,
+            "cumtime": ct,
+        })
+    rows.sort(key=lambda row: row["cumtime"], reverse=True)
+    return rows[:limit], stats.total_tt
+
+
+def top_allocations(name, limit=20):
+    try:
+        path = _path(name, ".snapshot")
+    except ValueError:
+        return []
+    statistics = tracemalloc.Snapshot.load(path).statistics("lineno")
+    return [{"location": str(stat.traceback), "size_kb": stat.size / 1024.0, "count": stat.count}
+            for stat in statistics[:limit]]
@@ -0,0 +1,187 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce, Length
+from django.utils import timezone
+from .models import StudyAnalysis, SimulationResult
+import os
+import time
+
+# Studies whose users never reached export_delete keep their pickled
+# dataframes and uploaded sheet forever. Retention removes studies that were
+# not accessed for CALCMAIN_RETENTION_DAYS, then the least recently accessed
+# ones until the studies fit in CALCMAIN_STORAGE_BUDGET_MB, and finally any
+# uploaded sheet no study refers to.
+
+UPLOAD_DIR = StudyAnalysis._meta.get_field("imported_sheet").upload_to
+PICKLED_FIELDS = ("processed_df", "sorted_df", "reassessed_dfs", "precomputed")
+SIMULATION_FIELDS = ("pr_rates", "pro_rates")
+
+
+class RetentionReport(object):
+
+    def __init__(self):
+        self.studies_deleted = 0
+        self.files_deleted = 0
+        self.orphans_deleted = 0
+        self.bytes_reclaimed = 0
+
+    def __str__(self):
+        return "%d studies, %d files (%d orphaned), %.1f MB reclaimed" % (
+            self.studies_deleted, self.files_deleted + self.orphans_deleted,
+            self.orphans_deleted, self.bytes_reclaimed / 1024.0 / 1024.0)
+
+
+def _file_size(name):
+    try:
+        return default_storage.size(name)
+    except (OSError, NotImplementedError):
+        return 0
+
+
+def _pickled_length(fields):
+    footprint = None
+    for name in fields:
+        length = Coalesce(Length(name), 0)
+        footprint = length if footprint is None else footprint + length
+    return footprint
+
+
+def _with_footprint(queryset):
+    # Bytes used by a row's pickled dataframes, without loading them
+    return queryset.annotate(footprint=_pickled_length(PICKLED_FIELDS))
+
+
+def _simulation_footprints(pks=None):
+    # Bytes used by the simulated rates of each study, deleted with it
+    queryset = SimulationResult.objects.all()
+    if pks is not None:
+        queryset = queryset.filter(study__in=pks)
+    rows = queryset.values("study").annotate(footprint=Sum(_pickled_length(SIMULATION_FIELDS)))
+    return {row["study"]: row["footprint"] or 0 for row in rows}
+
+
+def stale_studies(now=None, days=None):
+    now = now or timezone.now()
+    if days is None:
+        days = getattr(settings, "CALCMAIN_RETENTION_DAYS", 7)
+    cutoff = now - timedelta(days=days)
+    return StudyAnalysis.objects.filter(createdAt__lt=cutoff, lastAccessedAt__lt=cutoff)
+
+
+def over_budget_studies(budget_mb=None, exclude=()):
+    """Least recently accessed studies to drop to fit in the storage budget."""
+    if budget_mb is None:
+        budget_mb = getattr(settings, "CALCMAIN_STORAGE_BUDGET_MB", 500)
+    budget = budget_mb * 1024 * 1024
+
+    rows = list(_with_footprint(StudyAnalysis.objects.exclude(pk__in=exclude))
+                .order_by("lastAccessedAt")
+                .values_list("pk", "imported_sheet", "footprint"))
+    simulations = _simulation_footprints()
+    sizes = [(pk, footprint + simulations.get(pk, 0) + _file_size(name)) for pk, name, footprint in rows]
+    used = sum(size for pk, size in sizes)
+
+    pks = []
+    for pk, size in sizes:
+        if used <= budget:
+            break
+        pks.append(pk)
+        used -= size
+    return pks
+
+
+def _count_deleted(report, rows, simulations):
+    report.studies_deleted += len(rows)
+    report.bytes_reclaimed += sum(footprint + simulations.get(pk, 0) for pk, name, footprint in rows)
+
+
+def delete_studies(pks, report, batch_size=None, dry_run=False, pause=0.0, queryset=None):
+    """Delete studies in batches, along with their uploaded sheets.
+
+    `queryset` is re-applied to every batch, so studies that stopped
+    matching it while earlier batches were deleted are kept.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, "CALCMAIN_RETENTION_BATCH", 50)
+    if queryset is None:
+        queryset = StudyAnalysis.objects.all()
+    pks = list(pks)
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        rows = list(_with_footprint(queryset.filter(pk__in=batch))
+                    .values_list("pk", "imported_sheet", "footprint"))
+        simulations = _simulation_footprints([pk for pk, name, footprint in rows])
+        if dry_run:
+            _count_deleted(report, rows, simulations)
+            report.files_deleted += sum(1 for pk, name, footprint in rows if name)
+            report.bytes_reclaimed += sum(_file_size(name) for pk, name, footprint in rows if name)
+            continue
+
+        # Short transactions so the sqlite write lock is released between batches
+        with transaction.atomic():
+            queryset.filter(pk__in=[pk for pk, name, footprint in rows]).only("pk", "imported_sheet").delete()
+
+        # A study reopened since it was selected still has its row, keep its file too
+        remaining = set(StudyAnalysis.objects.filter(pk__in=[pk for pk, name, footprint in rows])
+                        .values_list("pk", flat=True))
+        deleted = [row for row in rows if row[0] not in remaining]
+        _count_deleted(report, deleted, simulations)
+
+        # Files go once the rows are committed, outside the write lock
+        for pk, name, footprint in deleted:
+            if not name:
+                continue
+            size = _file_size(name)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+                report.files_deleted += 1
+                report.bytes_reclaimed += size
+        if pause:
+            time.sleep(pause)
+
+
+def delete_orphans(report, grace_seconds=3600, dry_run=False):
+    """Delete uploaded sheets that no study refers to."""
+    try:
+        directories, names = default_storage.listdir(UPLOAD_DIR)
+    except OSError:
+        return
+    referenced = set(StudyAnalysis.objects.values_list("imported_sheet", flat=True))
+    now = timezone.now()
+    for filename in names:
+        name = os.path.join(UPLOAD_DIR, filename)
+        if name in referenced:
+            continue
+        # Skip files of uploads that may still be saving their study row
+        try:
+            modified = default_storage.get_modified_time(name)
+        except (OSError, NotImplementedError):
+            continue
+        if (now - modified).total_seconds() < grace_seconds:
+            continue
+        size = _file_size(name)
+        if not dry_run:
+            default_storage.delete(name)
+        report.orphans_deleted += 1
+        report.bytes_reclaimed += size
+
+
+def vacuum():
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM")
+
+
+def purge(days=None, budget_mb=None, batch_size=None, dry_run=False, pause=0.0):
+    report = RetentionReport()
+    stale_queryset = stale_studies(days=days)
+    stale = list(stale_queryset.order_by("lastAccessedAt").values_list("pk", flat=True))
+    # A study reopened during --pause no longer matches the queryset and is kept
+    delete_studies(stale, report, batch_size=batch_size, dry_run=dry_run, pause=pause, queryset=stale_queryset)
+    over_budget = over_budget_studies(budget_mb=budget_mb, exclude=stale)
+    delete_studies(over_budget, report, batch_size=batch_size, dry_run=dry_run, pause=pause)
+    delete_orphans(report, dry_run=dry_run)
+    return report
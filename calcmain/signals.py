@@ -0,0 +1,27 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import StudyAnalysis
+from . import precompute
+
+
+@receiver(post_save, sender=StudyAnalysis)
+def schedule_precompute(sender, instance, update_fields=None, **kwargs):
+    # Views save the study on every step, only a new upload or a changed
+    # number of UP patients restarts the pipeline
+    if update_fields is not None and not {"imported_sheet", "up_patients"} & set(update_fields):
+        return
+    # A study without a file is being deleted, there is nothing to compute
+    if not instance.imported_sheet:
+        return
+    digest = precompute.upload_digest(instance)
+    if digest == instance.upload_digest:
+        return
+    instance.upload_digest = digest
+    instance.precomputed = {}
+    StudyAnalysis.objects.filter(pk=instance.pk).update(upload_digest=digest, precomputed={})
+    precompute.schedule(instance)
+
+
+@receiver(post_delete, sender=StudyAnalysis)
+def cancel_precompute(sender, instance, **kwargs):
+    precompute.cancel(instance.pk)
@@ -0,0 +1,255 @@
+from django.conf import settings
+from .models import SimulationResult
+import hashlib
+import math
+import numpy as np
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def simulate(p_pr, p_pro, trials, rng=None):
+    """Draw `trials` reassessments of every patient at once.
+
+    Returns the observed partial response and progression rates of each
+    trial, in whole percents. Rates are rounded down in integer arithmetic:
+    29 responders of 100 give 29%, where the former sum / n * 100 in floats
+    gave 28.999... and was truncated to 28%.
+    """
+    rng = rng or np.random
+    n = len(p_pr)
+    pr = (rng.random_sample((trials, n)) < p_pr).sum(axis=1)
+    pro = (rng.random_sample((trials, n)) < p_pro).sum(axis=1)
+    return (pr * 100 // n).astype(int), (pro * 100 // n).astype(int)
+
+
+def central_range(rates):
+    """2.5th percentile, median and 97.5th percentile of simulated rates.
+
+    With 1000 trials these are the 26th, the mean of the 500th and 501st,
+    and the 975th sorted values.
+    """
+    rates = np.sort(rates)
+    n = len(rates)
+    bottom = rates[int(0.025 * n)]
+    top = rates[int(math.ceil(0.975 * n)) - 1]
+    if n % 2:
+        median = rates[n // 2]
+    else:
+        median = int((rates[n // 2 - 1] + rates[n // 2]) / 2)
+    return int(bottom), int(median), int(top)
+
+
+def quantile_error(rates, batch):
+    """Monte Carlo standard error of central_range, by batch means.
+
+    The trials are split into batches of `batch`, and the spread of the
+    batches' quantiles is scaled down to the full number of trials.
+    """
+    groups = len(rates) // batch
+    if groups < 2:
+        return float("inf")
+    quantiles = np.array([central_range(rates[i * batch:(i + 1) * batch]) for i in range(groups)], dtype=float)
+    return float((quantiles.std(axis=0, ddof=1) / math.sqrt(groups)).max())
+
+
+def adaptive_simulate(p_pr, p_pro, precision=None, max_trials=None, batch=None, min_batches=3, rng=None):
+    """Simulate in batches until the quantiles are stable to `precision`.
+
+    `precision` is the largest accepted standard error of the 2.5/50/97.5
+    percentiles, in percentage points. Stops at `max_trials` otherwise.
+    Returns the PR and progression rates, and the achieved precision.
+    """
+    if precision is None:
+        precision = _setting("CALCMAIN_ADAPTIVE_PRECISION", 0.5)
+    if max_trials is None:
+        max_trials = _setting("CALCMAIN_ADAPTIVE_MAX_TRIALS", 20000)
+    if batch is None:
+        batch = _setting("CALCMAIN_ADAPTIVE_BATCH", 200)
+    # Rejects NaN and infinity too, which would never stop before max_trials
+    if not (math.isfinite(precision) and precision > 0):
+        raise ValueError("precision must be a positive number of percentage points")
+
+    pr_batches, pro_batches = [], []
+    trials = 0
+    error = float("inf")
+    while trials < max_trials:
+        size = min(batch, max_trials - trials)
+        pr, pro = simulate(p_pr, p_pro, size, rng)
+        pr_batches.append(pr)
+        pro_batches.append(pro)
+        trials += size
+        if len(pr_batches) < min_batches:
+            continue
+        pr_rates = np.concatenate(pr_batches)
+        pro_rates = np.concatenate(pro_batches)
+        error = max(quantile_error(pr_rates, batch), quantile_error(pro_rates, batch))
+        if error <= precision:
+            break
+    return np.concatenate(pr_batches), np.concatenate(pro_batches), error
+
+
+def response_probabilities(reassessed_df, up_patients):
+    """Per-patient PR and progression probabilities, UP patients included.
+
+    Patients with unequivocal progression, symptomatic progression or death
+    have probability 0 for PR and 1 for progression at reassessment.
+    """
+    p_pr = np.concatenate([reassessed_df.loc[:, 'new_PR'].values.astype(float), np.zeros(up_patients)])
+    p_pro = np.concatenate([reassessed_df.loc[:, 'new_PRO'].values.astype(float), np.ones(up_patients)])
+    return p_pr, p_pro
+
+
+def input_version(p_pr, p_pro):
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(p_pr, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(p_pro, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def precision_step(precision):
+    """Round a requested precision to CALCMAIN_ADAPTIVE_PRECISION_STEP.
+
+    Memoized results are keyed by precision, so it is also clamped to
+    [step, CALCMAIN_ADAPTIVE_MAX_PRECISION]: a study has at most a few
+    dozen adaptive results, whatever the query strings.
+    """
+    if not precision:
+        return 0
+    step = _setting("CALCMAIN_ADAPTIVE_PRECISION_STEP", 0.1)
+    steps = int(round(_setting("CALCMAIN_ADAPTIVE_MAX_PRECISION", 5.0) / step))
+    return round(min(max(1, int(round(precision / step))), steps) * step, 6)
+
+
+def final_distribution(study, reassessed_df, observer, precision=0):
+    """Memoized final-result distribution of a study's reassessed data.
+
+    Keyed by study, observer model, input version, trial count, seed and
+    requested precision, so reloads return identical numbers. A precision
+    of 0 runs CALCMAIN_SIMULATION_TRIALS trials, otherwise the simulation
+    is adaptive with at most CALCMAIN_ADAPTIVE_MAX_TRIALS trials.
+    """
+    precision = precision_step(precision)
+    if precision:
+        trials = _setting("CALCMAIN_ADAPTIVE_MAX_TRIALS", 20000)
+    else:
+        trials = _setting("CALCMAIN_SIMULATION_TRIALS", 1000)
+    p_pr, p_pro = response_probabilities(reassessed_df, study.up_patients)
+    key = {
+        "study": study,
+        "observer": observer,
+        "version": input_version(p_pr, p_pro),
+        "trials": trials,
+        "seed": study.simulation_seed,
+        "precision": precision,
+    }
+    try:
+        return SimulationResult.objects.get(**key)
+    except SimulationResult.DoesNotExist:
+        pass
+
+    rng = np.random.RandomState(study.simulation_seed)
+    if precision:
+        pr_rates, pro_rates, error = adaptive_simulate(p_pr, p_pro, precision=precision, max_trials=trials, rng=rng)
+    else:
+        pr_rates, pro_rates = simulate(p_pr, p_pro, trials, rng)
+        batch = _setting("CALCMAIN_ADAPTIVE_BATCH", 200)
+        error = max(quantile_error(pr_rates, batch), quantile_error(pro_rates, batch))
+    defaults = {
+        "pr_rates": pr_rates,
+        "pro_rates": pro_rates,
+        "error": error if np.isfinite(error) else None,
+    }
+    result, created = SimulationResult.objects.get_or_create(defaults=defaults, **key)
+    return result
+
+
+def simulate_arms(arms, trials, rng=None, chunk=250):
+    """Observed PR and progression rates of several arms in one batched draw.
+
+    `arms` is a list of (p_pr, p_pro) arrays. The arms are padded with zero
+    probabilities to the largest arm, so every trial reassesses all arms'
+    patients at once. Returns two (trials, arms) arrays of rates in percents.
+    """
+    rng = rng or np.random
+    sizes = np.array([len(p_pr) for p_pr, p_pro in arms], dtype=float)
+    p_pr = np.zeros((len(arms), int(sizes.max())))
+    p_pro = np.zeros_like(p_pr)
+    for i, (arm_pr, arm_pro) in enumerate(arms):
+        p_pr[i, :len(arm_pr)] = arm_pr
+        p_pro[i, :len(arm_pro)] = arm_pro
+
+    pr_rates, pro_rates = [], []
+    for start in range(0, trials, chunk):
+        size = min(chunk, trials - start)
+        pr_rates.append((rng.random_sample((size,) + p_pr.shape) < p_pr).sum(axis=2) * 100 / sizes)
+        pro_rates.append((rng.random_sample((size,) + p_pro.shape) < p_pro).sum(axis=2) * 100 / sizes)
+    return np.concatenate(pr_rates), np.concatenate(pro_rates)
+
+
+def poisson_binomial_pmf(p):
+    """Exact distribution of the number of successes of independent Bernoullis."""
+    pmf = np.ones(1)
+    for prob in p:
+        pmf = np.convolve(pmf, [1 - prob, prob])
+    return pmf
+
+
+def exact_difference(p_treatment, p_control):
+    """Exact distribution of the difference of two arms' rates, in percents.
+
+    Returns P(treatment rate > control rate), P(equal rates) and the
+    2.5th, 50th and 97.5th percentiles of the difference. Builds arrays of
+    (n_t + 1) * (n_c + 1) outcomes, see CALCMAIN_EXACT_MAX_PATIENTS.
+    """
+    pmf_t = poisson_binomial_pmf(p_treatment)
+    pmf_c = poisson_binomial_pmf(p_control)
+    rates_t = np.arange(len(pmf_t)) * 100.0 / len(p_treatment)
+    rates_c = np.arange(len(pmf_c)) * 100.0 / len(p_control)
+    difference = np.subtract.outer(rates_t, rates_c).ravel()
+    weight = np.multiply.outer(pmf_t, pmf_c).ravel()
+
+    order = np.argsort(difference, kind="mergesort")
+    difference, weight = difference[order], weight[order]
+    cdf = np.cumsum(weight)
+    quantiles = [float(difference[min(np.searchsorted(cdf, q), len(cdf) - 1)]) for q in (0.025, 0.5, 0.975)]
+    return float(weight[difference > 0].sum()), float(weight[difference == 0].sum()), quantiles
+
+
+def compare_arms(arms, trials=None, rng=None):
+    """Compare every arm against the first (control) arm.
+
+    `arms` is a list of (p_pr, p_pro) arrays. For each treatment arm returns
+    the simulated and exact differences in ORR and progression rate, and the
+    probability that the arm beats the control: a higher ORR, a lower
+    progression rate. The exact results are None for arms larger than
+    CALCMAIN_EXACT_MAX_PATIENTS.
+    """
+    if trials is None:
+        trials = _setting("CALCMAIN_SIMULATION_TRIALS", 1000)
+    max_patients = _setting("CALCMAIN_EXACT_MAX_PATIENTS", 1000)
+    pr_rates, pro_rates = simulate_arms(arms, trials, rng)
+    control_pr, control_pro = arms[0]
+
+    results = []
+    for i, (p_pr, p_pro) in enumerate(arms[1:], start=1):
+        diff_pr = pr_rates[:, i] - pr_rates[:, 0]
+        diff_pro = pro_rates[:, i] - pro_rates[:, 0]
+        result = {
+            "orr_difference": [float(q) for q in np.percentile(diff_pr, [2.5, 50, 97.5])],
+            "orr_better": float((diff_pr > 0).mean()),
+            "orr_difference_exact": None,
+            "orr_better_exact": None,
+            "progression_difference": [float(q) for q in np.percentile(diff_pro, [2.5, 50, 97.5])],
+            "progression_better": float((diff_pro < 0).mean()),
+            "progression_difference_exact": None,
+            "progression_better_exact": None,
+        }
+        if max(len(p_pr), len(control_pr)) <= max_patients:
+            better_pr, tie_pr, result["orr_difference_exact"] = exact_difference(p_pr, control_pr)
+            worse_pro, tie_pro, result["progression_difference_exact"] = exact_difference(p_pro, control_pro)
+            result["orr_better_exact"] = better_pr
+            result["progression_better_exact"] = 1 - worse_pro - tie_pro
+        results.append(result)
+    return results
@@ -0,0 +1,171 @@
+from . import pipeline, precompute
+import hashlib
+import pandas as pd
+
+# The wizard's computations as a small dependency graph. Every stage declares
+# its inputs, and its version is a hash of its inputs' versions, down to the
+# sources: the uploaded sheet and the probability tables. A stored result is
+# reused while its recorded version matches, so any result page can be opened
+# directly and only missing or stale stages are computed.
+#
+#   upload -> processed -> sorted
+#                      \
+#   tables(observer) ---> reassessed
+#
+# Stages that depend on the tables keep one result and one version per
+# observer model, e.g. "reassessed:inter", so rebuilding one model's result
+# never invalidates the other's.
+#
+# The final distributions are not a stage: simulation.final_distribution
+# memoizes them keyed by the reassessed probabilities and up_patients.
+
+
+def _upload_version(study, observer):
+    return study.imported_sheet.name
+
+
+def _tables_version(study, observer):
+    return pipeline.tables_version(observer)
+
+
+SOURCES = {
+    "upload": _upload_version,
+    "tables": _tables_version,
+}
+
+
+class Stage(object):
+
+    def __init__(self, name, field, inputs, compute, precomputed=None):
+        self.name = name
+        self.field = field
+        self.inputs = inputs
+        self.compute = compute
+        # Key of the stage's result in StudyAnalysis.precomputed, if any
+        self.precomputed = precomputed
+
+    def depends_on_observer(self):
+        return any(name == "tables" or (name in STAGES and STAGES[name].depends_on_observer())
+                   for name in self.inputs)
+
+
+class LongitudinalSheet(Exception):
+    """The upload has a timepoint column, see the data_longitudinal view."""
+
+
+def _process(study, inputs, observer):
+    process_df = precompute.fetch(study, "processed_df")
+    if process_df is None:
+        main_df = pipeline.read_sheet(study)
+        if pipeline.is_longitudinal(main_df):
+            raise LongitudinalSheet(study.pk)
+        process_df = pipeline.process_sheet(main_df)
+    return process_df
+
+
+def _summarize(study, inputs, observer):
+    sorted_df = precompute.fetch(study, "sorted_df")
+    if sorted_df is None:
+        sorted_df = pipeline.summarize(inputs["processed"])
+    return sorted_df
+
+
+def _reassess(study, inputs, observer):
+    reassessed_df = precompute.fetch(study, "reassessed_" + observer, observer=observer)
+    if reassessed_df is None:
+        reassessed_df = pipeline.reassess(inputs["processed"], pipeline.load_probability_tables(observer))
+    return reassessed_df
+
+
+STAGES = {
+    "processed": Stage("processed", "processed_df", ["upload"], _process, "processed_df"),
+    "sorted": Stage("sorted", "sorted_df", ["processed"], _summarize, "sorted_df"),
+    "reassessed": Stage("reassessed", "reassessed_dfs", ["processed", "tables"], _reassess, "reassessed_{observer}"),
+}
+
+
+def version(study, name, observer=None, _cache=None):
+    """Version hash of a stage or source, without computing anything."""
+    cache = {} if _cache is None else _cache
+    if name not in cache:
+        if name in SOURCES:
+            cache[name] = SOURCES[name](study, observer)
+        else:
+            digest = hashlib.sha1(name.encode("utf-8"))
+            if STAGES[name].depends_on_observer():
+                digest.update(observer.encode("utf-8"))
+            for input_name in STAGES[name].inputs:
+                digest.update(version(study, input_name, observer, cache).encode("utf-8"))
+            cache[name] = digest.hexdigest()
+    return cache[name]
+
+
+def _key(name, observer):
+    return "%s:%s" % (name, observer) if STAGES[name].depends_on_observer() else name
+
+
+def stored(study, name, observer=None):
+    """A stage's stored result, current or not, or None."""
+    value = getattr(study, STAGES[name].field)
+    if STAGES[name].depends_on_observer():
+        # A dict of results by observer model
+        value = value.get(observer) if isinstance(value, dict) else None
+    return value if isinstance(value, pd.DataFrame) else None
+
+
+def is_current(study, name, observer=None, _cache=None):
+    versions = study.stage_versions if isinstance(study.stage_versions, dict) else {}
+    if stored(study, name, observer) is None:
+        return False
+    return versions.get(_key(name, observer)) == version(study, name, observer, _cache)
+
+
+def resolve(study, name, observer=None, store=True):
+    """Return a stage's result, computing only missing or stale upstream stages.
+
+    With store=False computed results are not saved, the study is only read.
+    Raises ProbExcelSheets.DoesNotExist when a needed probability table is
+    not imported, and LongitudinalSheet for long-format uploads.
+    """
+    return _resolve(study, name, observer, {}, store)
+
+
+def _resolve(study, name, observer, cache, store=True):
+    if name in SOURCES:
+        return version(study, name, observer, cache)
+    stage = STAGES[name]
+    expected = version(study, name, observer, cache)
+    if is_current(study, name, observer, cache):
+        return stored(study, name, observer)
+
+    inputs = {input_name: _resolve(study, input_name, observer, cache, store) for input_name in stage.inputs}
+    value = stage.compute(study, inputs, observer)
+    if not store:
+        return value
+
+    if not isinstance(study.stage_versions, dict):
+        study.stage_versions = {}
+    study.stage_versions[_key(name, observer)] = expected
+    if stage.depends_on_observer():
+        results = getattr(study, stage.field)
+        results = dict(results) if isinstance(results, dict) else {}
+        results[observer] = value
+        setattr(study, stage.field, results)
+    else:
+        setattr(study, stage.field, value)
+    study.save(update_fields=[stage.field, "stage_versions"])
+    # The stored field is now the only copy that is kept
+    if stage.precomputed:
+        precompute.discard(study, stage.precomputed.format(observer=observer))
+    return value
+
+
+def current_observer(study, default="intra"):
+    """The observer model last chosen in the wizard, the final result's default."""
+    return study.reassessed_observer if study.reassessed_observer in pipeline.OBSERVERS else default
+
+
+def choose_observer(study, observer):
+    if study.reassessed_observer != observer:
+        study.reassessed_observer = observer
+        study.save(update_fields=["reassessed_observer"])
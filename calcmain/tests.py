@@ -1,3 +1,332 @@
-from django.test import TestCase
+from datetime import timedelta
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from unittest import mock
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+from .models import StudyAnalysis
+from . import pipeline, retention, simulation, stages
 
-# Create your tests here.
+
+class PoissonBinomialTests(SimpleTestCase):
+
+    def test_no_patients(self):
+        np.testing.assert_allclose(simulation.poisson_binomial_pmf([]), [1])
+
+    def test_two_fair_coins(self):
+        np.testing.assert_allclose(simulation.poisson_binomial_pmf([0.5, 0.5]), [0.25, 0.5, 0.25])
+
+    def test_certain_and_uncertain_patients(self):
+        # The third patient always responds: 0.8 * 0.5, 0.2 * 0.5 + 0.8 * 0.5, 0.2 * 0.5, shifted by one
+        np.testing.assert_allclose(simulation.poisson_binomial_pmf([0.2, 0.5, 1.0]), [0, 0.4, 0.5, 0.1])
+
+
+class ExactDifferenceTests(SimpleTestCase):
+
+    def test_certain_difference(self):
+        better, tie, quantiles = simulation.exact_difference([1.0], [0.0])
+        self.assertAlmostEqual(better, 1)
+        self.assertAlmostEqual(tie, 0)
+        self.assertEqual(quantiles, [100, 100, 100])
+
+    def test_fair_coins(self):
+        # Differences -100, 0 and 100 with probabilities 1/4, 1/2 and 1/4
+        better, tie, quantiles = simulation.exact_difference([0.5], [0.5])
+        self.assertAlmostEqual(better, 0.25)
+        self.assertAlmostEqual(tie, 0.5)
+        self.assertEqual(quantiles, [-100, 0, 100])
+
+    def test_arms_of_different_sizes(self):
+        # The treatment rate is always 50%, the control rate 0% or 100%
+        better, tie, quantiles = simulation.exact_difference([1.0, 0.0], [0.5])
+        self.assertAlmostEqual(better, 0.5)
+        self.assertAlmostEqual(tie, 0)
+        self.assertEqual(quantiles, [-50, -50, 50])
+
+
+@override_settings(CALCMAIN_ADAPTIVE_PRECISION_STEP=0.1, CALCMAIN_ADAPTIVE_MAX_PRECISION=5.0)
+class PrecisionStepTests(SimpleTestCase):
+
+    def test_fixed_trials(self):
+        self.assertEqual(simulation.precision_step(0), 0)
+
+    def test_rounded_to_step(self):
+        self.assertEqual(simulation.precision_step(0.46), 0.5)
+        self.assertEqual(simulation.precision_step(0.01), 0.1)
+
+    def test_clamped(self):
+        self.assertEqual(simulation.precision_step(12345.6), 5.0)
+        self.assertEqual(simulation.precision_step(1e9), 5.0)
+
+
+class CompareArmsTests(SimpleTestCase):
+
+    def test_certain_arms(self):
+        control = (np.zeros(2), np.ones(2))
+        treatment = (np.ones(2), np.zeros(2))
+        result, = simulation.compare_arms([control, treatment], trials=10, rng=np.random.RandomState(0))
+        self.assertEqual(result["orr_difference"], [100, 100, 100])
+        self.assertEqual(result["orr_better"], 1)
+        self.assertEqual(result["orr_difference_exact"], [100, 100, 100])
+        self.assertAlmostEqual(result["orr_better_exact"], 1)
+        self.assertEqual(result["progression_difference"], [-100, -100, -100])
+        self.assertEqual(result["progression_better"], 1)
+        self.assertEqual(result["progression_difference_exact"], [-100, -100, -100])
+        self.assertAlmostEqual(result["progression_better_exact"], 1)
+
+    def test_simulation_agrees_with_exact(self):
+        # One treated patient responds with probability 1/2, the control never does
+        control = (np.zeros(1), np.ones(1))
+        treatment = (np.array([0.5]), np.array([0.5]))
+        result, = simulation.compare_arms([control, treatment], trials=4000, rng=np.random.RandomState(0))
+        self.assertAlmostEqual(result["orr_better_exact"], 0.5)
+        self.assertAlmostEqual(result["orr_better"], 0.5, delta=0.05)
+        self.assertAlmostEqual(result["progression_better_exact"], 0.5)
+        self.assertAlmostEqual(result["progression_better"], 0.5, delta=0.05)
+
+    @override_settings(CALCMAIN_EXACT_MAX_PATIENTS=1)
+    def test_large_arms_are_only_simulated(self):
+        control = (np.zeros(2), np.ones(2))
+        treatment = (np.ones(2), np.zeros(2))
+        result, = simulation.compare_arms([control, treatment], trials=10, rng=np.random.RandomState(0))
+        self.assertIsNone(result["orr_difference_exact"])
+        self.assertIsNone(result["progression_better_exact"])
+        self.assertEqual(result["orr_better"], 1)
+
+
+class LongitudinalTests(SimpleTestCase):
+    # Patient 1 has two solid tumors, patient 2 a single lymph node of 20 mm
+    # and patient 3 one of each
+    ROWS = [
+        [1, "Lung", 20, 10],
+        [1, "Liver", 30, 15],
+        [2, "Lymph node", 20, 30],
+        [3, "Lung", 10, 10],
+        [3, "lymph node", 15, 15],
+    ]
+
+    def _sheet(self):
+        return pd.DataFrame(self.ROWS, columns=['ID', 'Organ', 'Lesion size at baseline (mm)',
+                                                'Lesion size at post-treatment (mm)'])
+
+    def _long_sheet(self):
+        main_df = self._sheet()
+        main_df.insert(2, 'Timepoint', 1)
+        return main_df
+
+    def _tables(self):
+        change = np.arange(-99, 101)
+        tables = {}
+        for kind, columns in [("Multiple", ["20", "11"]), ("Singular", ["0120"])]:
+            for prefix, curve in [("PR", (100 - change) / 200.0), ("Pro", (change + 99) / 199.0)]:
+                table = pd.DataFrame({column: curve * (i + 1) / len(columns) for i, column in enumerate(columns)},
+                                     index=pd.Index(change, name="PercentChange"))
+                tables[prefix + "_" + kind] = table
+        return tables
+
+    def test_is_longitudinal(self):
+        self.assertTrue(pipeline.is_longitudinal(self._long_sheet()))
+        self.assertFalse(pipeline.is_longitudinal(self._sheet()))
+        five_columns = self._sheet()
+        five_columns.insert(2, 'Comment', "")
+        self.assertFalse(pipeline.is_longitudinal(five_columns))
+
+    def test_one_timepoint_matches_process_sheet(self):
+        processed_df = pipeline.process_sheet(self._sheet())
+        longitudinal_df = pipeline.process_longitudinal(self._long_sheet())
+        assert_frame_equal(longitudinal_df.drop('Timepoint', axis=1)[processed_df.columns], processed_df,
+                           check_dtype=False)
+
+    def test_one_timepoint_matches_reassess(self):
+        tables = self._tables()
+        reassessed_df = pipeline.reassess(pipeline.process_sheet(self._sheet()), tables)
+        longitudinal_df = pipeline.reassess_longitudinal(pipeline.process_longitudinal(self._long_sheet()), tables)
+        columns = ['ID', 'PC', 'old_status', 'new_PR', 'new_PRO']
+        assert_frame_equal(longitudinal_df[columns], reassessed_df[columns], check_dtype=False)
+
+    def test_timepoints_in_natural_order(self):
+        reassessed_df = pd.DataFrame({
+            'Timepoint': ["Week 10", "Week 2", "week 6"],
+            'PC': [-50, 0, 30],
+            'new_PR': [1.0, 0.0, 0.0],
+            'new_PRO': [0.0, 0.0, 1.0],
+        })
+        trajectory_df = pipeline.trajectories(reassessed_df, 0)
+        self.assertEqual(list(trajectory_df['Timepoint']), ["Week 2", "week 6", "Week 10"])
+        self.assertEqual(list(trajectory_df['Observed ORR (%)']), [0, 0, 100])
+
+    def test_zero_baseline_burden(self):
+        main_df = self._long_sheet()
+        main_df.loc[main_df['ID'] == 2, 'Lesion size at baseline (mm)'] = 0
+        with self.assertRaises(ValueError):
+            pipeline.process_longitudinal(main_df)
+
+
+@override_settings(CALCMAIN_PRECOMPUTE=False)
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.now = timezone.now()
+
+    def _study(self, created_days_ago, accessed_days_ago=None):
+        study = StudyAnalysis.objects.create(study_name="Study", treatment_name="Treatment", up_patients=0,
+                                             imported_sheet=ContentFile(b"sheet", name="sheet.xlsx"))
+        if accessed_days_ago is None:
+            accessed_days_ago = created_days_ago
+        StudyAnalysis.objects.filter(pk=study.pk).update(
+            createdAt=self.now - timedelta(days=created_days_ago),
+            lastAccessedAt=self.now - timedelta(days=accessed_days_ago))
+        return StudyAnalysis.objects.get(pk=study.pk)
+
+    def test_stale_studies(self):
+        stale = self._study(10)
+        self._study(10, accessed_days_ago=1)
+        self._study(1)
+        self.assertEqual(list(retention.stale_studies(now=self.now, days=7)), [stale])
+
+    def test_over_budget_studies(self):
+        oldest = self._study(3)
+        older = self._study(2)
+        newest = self._study(1)
+        self.assertEqual(retention.over_budget_studies(budget_mb=0), [oldest.pk, older.pk, newest.pk])
+        self.assertEqual(retention.over_budget_studies(budget_mb=0, exclude=[older.pk]), [oldest.pk, newest.pk])
+        self.assertEqual(retention.over_budget_studies(budget_mb=1), [])
+
+    def test_delete_studies(self):
+        study = self._study(10)
+        report = retention.RetentionReport()
+        retention.delete_studies([study.pk], report)
+        self.assertFalse(StudyAnalysis.objects.filter(pk=study.pk).exists())
+        self.assertFalse(default_storage.exists(study.imported_sheet.name))
+        self.assertEqual((report.studies_deleted, report.files_deleted), (1, 1))
+
+    def test_dry_run(self):
+        study = self._study(10)
+        report = retention.RetentionReport()
+        retention.delete_studies([study.pk], report, dry_run=True)
+        self.assertTrue(StudyAnalysis.objects.filter(pk=study.pk).exists())
+        self.assertTrue(default_storage.exists(study.imported_sheet.name))
+        self.assertEqual((report.studies_deleted, report.files_deleted), (1, 1))
+
+    def test_reopened_study_keeps_its_row_and_file(self):
+        study = self._study(10)
+        queryset = retention.stale_studies(now=self.now, days=7)
+
+        def reopen(pks):
+            # The study is opened after its batch was selected, before it is deleted
+            StudyAnalysis.objects.filter(pk=study.pk).update(lastAccessedAt=self.now)
+            return {}
+
+        report = retention.RetentionReport()
+        with mock.patch.object(retention, "_simulation_footprints", side_effect=reopen):
+            retention.delete_studies([study.pk], report, queryset=queryset)
+        self.assertTrue(StudyAnalysis.objects.filter(pk=study.pk).exists())
+        self.assertTrue(default_storage.exists(study.imported_sheet.name))
+        self.assertEqual((report.studies_deleted, report.files_deleted), (0, 0))
+
+
+class FakeSheet(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeStudy(object):
+    """Just the fields the stages read, saving is a no-op."""
+
+    def __init__(self):
+        self.pk = 1
+        self.imported_sheet = FakeSheet("files/imported_sheets/first.xlsx")
+        self.up_patients = 2
+        self.processed_df = self.sorted_df = "None"
+        self.reassessed_dfs = {}
+        self.reassessed_observer = ""
+        self.stage_versions = {}
+        self.upload_digest = ""
+        self.precomputed = {}
+
+    def save(self, update_fields=None):
+        pass
+
+
+class StageTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tables = {"intra": "Intra_PR_Multiple=a.xlsx", "inter": "Inter_PR_Multiple=b.xlsx"}
+        patcher = mock.patch.multiple(
+            pipeline,
+            read_sheet=mock.Mock(return_value=pd.DataFrame()),
+            is_longitudinal=mock.Mock(return_value=False),
+            process_sheet=mock.Mock(side_effect=lambda main_df: pd.DataFrame({"processed": [1]})),
+            summarize=mock.Mock(side_effect=lambda processed_df: pd.DataFrame({"sorted": [1]})),
+            load_probability_tables=mock.Mock(side_effect=lambda observer: observer),
+            reassess=mock.Mock(side_effect=lambda processed_df, tables: pd.DataFrame({"observer": [tables]})),
+            tables_version=mock.Mock(side_effect=lambda observer: self.tables[observer]),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.study = FakeStudy()
+
+    def test_resolve_computes_missing_stages_once(self):
+        stages.resolve(self.study, "reassessed", "intra")
+        stages.resolve(self.study, "reassessed", "intra")
+        stages.resolve(self.study, "sorted")
+        self.assertEqual(pipeline.process_sheet.call_count, 1)
+        self.assertEqual(pipeline.reassess.call_count, 1)
+        self.assertEqual(pipeline.summarize.call_count, 1)
+
+    def test_upload_change_invalidates_everything(self):
+        for name in ("sorted", "reassessed"):
+            stages.resolve(self.study, name, "intra")
+        self.study.imported_sheet = FakeSheet("files/imported_sheets/second.xlsx")
+        for name in ("processed", "sorted", "reassessed"):
+            self.assertFalse(stages.is_current(self.study, name, "intra"))
+        stages.resolve(self.study, "reassessed", "intra")
+        self.assertEqual(pipeline.process_sheet.call_count, 2)
+        self.assertEqual(pipeline.reassess.call_count, 2)
+
+    def test_table_replacement_invalidates_that_observer_only(self):
+        for observer in ("intra", "inter"):
+            stages.resolve(self.study, "reassessed", observer)
+        self.tables["inter"] = "Inter_PR_Multiple=c.xlsx"
+        self.assertTrue(stages.is_current(self.study, "processed"))
+        self.assertTrue(stages.is_current(self.study, "reassessed", "intra"))
+        self.assertFalse(stages.is_current(self.study, "reassessed", "inter"))
+        stages.resolve(self.study, "reassessed", "inter")
+        self.assertEqual(pipeline.process_sheet.call_count, 1)
+        self.assertEqual(pipeline.reassess.call_count, 3)
+
+    def test_observers_are_stored_apart(self):
+        intra = stages.resolve(self.study, "reassessed", "intra")
+        inter = stages.resolve(self.study, "reassessed", "inter")
+        self.assertEqual(intra["observer"][0], "intra")
+        self.assertEqual(inter["observer"][0], "inter")
+        self.assertIs(stages.resolve(self.study, "reassessed", "intra"), intra)
+        self.assertEqual(pipeline.reassess.call_count, 2)
+        # Resolving is not a choice of observer model
+        self.assertEqual(self.study.reassessed_observer, "")
+
+    def test_resolve_without_storing(self):
+        stages.resolve(self.study, "processed")
+        reassessed_df = stages.resolve(self.study, "reassessed", "inter", store=False)
+        self.assertEqual(reassessed_df["observer"][0], "inter")
+        self.assertEqual(self.study.reassessed_dfs, {})
+        self.assertNotIn("reassessed:inter", self.study.stage_versions)
+        self.assertEqual(pipeline.process_sheet.call_count, 1)
+
+    def test_up_patients_change_invalidates_nothing(self):
+        for name in ("sorted", "reassessed"):
+            stages.resolve(self.study, name, "intra")
+        self.study.up_patients = 5
+        for name in ("processed", "sorted", "reassessed"):
+            self.assertTrue(stages.is_current(self.study, name, "intra"))
@@ -1,16 +1,27 @@
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils import timezone
 from .forms import SheetUploadForm
 from .models import StudyAnalysis, ProbExcelSheets
-import re
+from . import pipeline, precompute, profiling, simulation, stages
+from .profiling import profiled
 import math
 import pandas as pd
 import numpy as np
 from bokeh.charts import Bar, Histogram  # defaults, output_file, show
 from bokeh.models import Range1d, Span, Label, BoxAnnotation
+from bokeh.plotting import figure
 from bokeh.embed import components
 
 
+# Columns of the processed-patient table, in display order
+PROCESSED_COLUMNS = ['Patient ID', 'Number of solid organ tumors', 'Number of lymph nodes', 'Percentage change (%)', 'Tumor burden at baseline (mm)', 'Tumor burden at post-treatment (mm)']
+TABLE_PER_PAGE = 25
+TABLE_MAX_PER_PAGE = 200
+
+
 def mainpage(request):
     return render(request, "calcmain/mainpage.html", {})
 
@@ -19,6 +30,25 @@ def introduction(request):
     return render(request, "calcmain/introduction.html", {})
 
 
+def _get_study(pk):
+    # The precomputed results are only loaded by the stages that use them
+    study = get_object_or_404(StudyAnalysis.objects.defer("precomputed"), pk=pk)
+    # Record the access without rewriting the pickled dataframes
+    study.lastAccessedAt = timezone.now()
+    StudyAnalysis.objects.filter(pk=pk).update(lastAccessedAt=study.lastAccessedAt)
+    return study
+
+
+def _stage(study, name, observer=None, store=True):
+    # Computes the stage and any missing or stale stage it depends on
+    try:
+        return stages.resolve(study, name, observer, store=store)
+    except ProbExcelSheets.DoesNotExist:
+        raise Http404("Probability tables are not imported.")
+    except stages.LongitudinalSheet:
+        raise Http404("The data has several timepoints, see the longitudinal results.")
+
+
 def dataimport(request):
     if request.method == "POST":
         form = SheetUploadForm(request.POST, request.FILES)
@@ -33,8 +63,9 @@ def dataimport(request):
     return render(request, "calcmain/dataimport.html", context)
 
 
+@profiled
 def data_confirm(request, pk):
-    study = get_object_or_404(StudyAnalysis, pk=pk)
+    study = _get_study(pk)
     up_patients = study.up_patients
     main_df = pd.read_excel(study.imported_sheet, sheetname=0)
     num_patients_imported = len(main_df.ID.unique())
@@ -48,66 +79,81 @@ def data_confirm(request, pk):
     return render(request, "calcmain/data_confirm.html", context)
 
 
+@profiled
 def data_process(request, pk):
-    study = get_object_or_404(StudyAnalysis, pk=pk)
-    main_df = pd.read_excel(study.imported_sheet, sheetname=0)
-
-    # Change column names and change uppercase characters(organ) into lowercase
-    main_df.columns = ['ID', 'Organ', 'Lesion size at baseline (mm)', 'Lesion size at post-treatment (mm)']
-    main_df["Organ"] = main_df["Organ"].str.lower()
-
-    # Generate a dataframe for processing the data
-    process_df = pd.DataFrame({'Patient ID': list(set([int(i) for i in main_df.ID]))})
-    process_df.loc[:, "Number of solid organ tumors"] = 0
-    process_df.loc[:, "Number of lymph nodes"] = 0
-    process_df.loc[:, "Tumor burden at baseline (mm)"] = 0  # Sum of all lesion size at baseline per patient(ID)
-    process_df.loc[:, "Tumor burden at post-treatment (mm)"] = 0 # Sum of all lesion size at post-treatment per patient(ID)
-    process_df.loc[:, "Lesion size at baseline (mm)"] = np.nan # For checking patients who have only one lesion (Solid or Lymph)
-    process_df.loc[:, "Percentage change (%)"] = 0
-
-    # Check records and update cells
-    for record in range(len(main_df.index)):
-        record_id = main_df.iloc[:, 0][record]
-        lesion_name = main_df.iloc[:, 1][record]
-        input_id = record_id - 1
-
-        if re.match("lymph*", lesion_name):
-            process_df.loc[input_id, "Number of lymph nodes"] += 1
-        else:
-            process_df.loc[input_id, "Number of solid organ tumors"] += 1
-        process_df.loc[input_id, "Tumor burden at baseline (mm)"] += main_df.iloc[:, 2][record]
-        process_df.loc[input_id, "Tumor burden at post-treatment (mm)"] += main_df.iloc[:, 3][record]
-
-
-    process_df.loc[:, "Number of solid organ tumors"] = process_df.loc[:, "Number of solid organ tumors"].astype(int)
-    process_df.loc[:, "Number of lymph nodes"] = process_df.loc[:, "Number of lymph nodes"].astype(int)
-    process_df.loc[:, "Tumor burden at baseline (mm)"] = process_df.loc[:, "Tumor burden at baseline (mm)"].astype(int)
-    process_df.loc[:, "Tumor burden at post-treatment (mm)"] = process_df.loc[:, "Tumor burden at post-treatment (mm)"].astype(int)
-
-    # Check processed dataframe and update cells
-    for record in range(len(process_df.index)):
-        process_df.loc[record, 'Percentage change (%)'] = math.floor((process_df.loc[record, "Tumor burden at post-treatment (mm)"] - process_df.loc[record, "Tumor burden at baseline (mm)"]) / process_df.loc[record, "Tumor burden at baseline (mm)"] * 100)
-        if process_df.loc[record, 'Percentage change (%)'] == -100:
-            process_df.loc[record, 'Percentage change (%)'] = -99
-        if process_df.loc[record, "Number of lymph nodes"] + process_df.loc[record, "Number of solid organ tumors"] == 1:
-            process_df.loc[record, "Lesion size at baseline (mm)"] = int(main_df.loc[main_df['ID'] == record + 1]['Lesion size at baseline (mm)'])
-
-    study.processed_df = process_df
-    study.save()
-
+    study = _get_study(pk)
+    try:
+        process_df = stages.resolve(study, "processed")
+    except stages.LongitudinalSheet:
+        # Long-format sheets with a timepoint column are processed as a whole
+        return redirect('calcmain:data_longitudinal', pk=study.pk)
+
+    # Only the table shell is rendered, rows are served by data_process_table
     context = {
         "study": study,
-        "data": process_df.to_html(
-            columns=['Patient ID', 'Number of solid organ tumors', 'Number of lymph nodes', 'Percentage change (%)', 'Tumor burden at baseline (mm)', 'Tumor burden at post-treatment (mm)'],
-            index=False, na_rep="", bold_rows=True, classes=["table", "table-hover", "table-processed"])
+        "columns": PROCESSED_COLUMNS,
+        "num_patients": len(process_df.index),
+        "per_page": TABLE_PER_PAGE
     }
     return render(request, "calcmain/data_processed.html", context)
 
 
+@profiled
+def data_process_table(request, pk):
+    # Only what resolving the processed stage needs, every page request loads this row
+    study = get_object_or_404(StudyAnalysis.objects.only("processed_df", "stage_versions", "imported_sheet", "upload_digest"), pk=pk)
+    try:
+        process_df = stages.resolve(study, "processed")
+    except stages.LongitudinalSheet:
+        return JsonResponse({"error": "The data has several timepoints."}, status=404)
+
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+        per_page = min(max(int(request.GET.get("per_page", TABLE_PER_PAGE)), 1), TABLE_MAX_PER_PAGE)
+        sort = int(request.GET.get("sort", 0))
+        pc_min = request.GET.get("pc_min")
+        pc_max = request.GET.get("pc_max")
+        pc_min = float(pc_min) if pc_min not in (None, "") else None
+        pc_max = float(pc_max) if pc_max not in (None, "") else None
+        if not 0 <= sort < len(PROCESSED_COLUMNS):
+            raise ValueError(sort)
+    except ValueError:
+        return JsonResponse({"error": "Invalid table parameters."}, status=400)
+    ascending = request.GET.get("order", "asc") != "desc"
+    single = request.GET.get("single")
+
+    # Filter with boolean masks, then sort and slice only the requested page
+    mask = np.ones(len(process_df.index), dtype=bool)
+    if pc_min is not None:
+        mask &= (process_df["Percentage change (%)"] >= pc_min).values
+    if pc_max is not None:
+        mask &= (process_df["Percentage change (%)"] <= pc_max).values
+    if single in ("1", "0"):
+        num_lesions = process_df["Number of solid organ tumors"] + process_df["Number of lymph nodes"]
+        mask &= ((num_lesions == 1).values == (single == "1"))
+    filtered_df = process_df.loc[mask, PROCESSED_COLUMNS]
+
+    total = len(filtered_df.index)
+    start = (page - 1) * per_page
+    order = np.argsort(filtered_df[PROCESSED_COLUMNS[sort]].values, kind="mergesort")
+    if not ascending:
+        order = order[::-1]
+    page_df = filtered_df.iloc[order[start:start + per_page]]
+
+    return JsonResponse({
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "columns": PROCESSED_COLUMNS,
+        "rows": [[int(value) for value in row] for row in page_df.values.tolist()]
+    })
+
+
+@profiled
 def data_summary(request, pk):
 
-    study = get_object_or_404(StudyAnalysis, pk=pk)
-    processed_df = study.processed_df
+    study = _get_study(pk)
+    processed_df = _stage(study, "processed")
     up_patients = study.up_patients
     num_all_patients = len(processed_df.index) + up_patients
 
@@ -123,12 +169,7 @@ def data_summary(request, pk):
     progression_prop = round((num_progression + up_patients) / num_all_patients * 100, 2)
 
     # Draw a plot for visualizing patients' diagnosis results.
-    new_data = {'Index': [i + 1 for i in range(len(processed_df.index))],
-               'Percentage change (%)': sorted(processed_df.loc[:, "Percentage change (%)"], reverse=True)}
-    sorted_df = pd.DataFrame(new_data)
-
-    study.sorted_df = sorted_df
-    study.save()
+    sorted_df = _stage(study, "sorted")
 
     sorted_plot = Bar(sorted_df, values='Percentage change (%)', color="White", title='Percentage change (%)', legend=None, ylabel="", ygrid=False)
     sorted_plot.y_range = Range1d(-100, 100)
@@ -172,69 +213,16 @@ def data_summary(request, pk):
 
 
 # Calculate the intra-observer measurement error
+@profiled
 def data_reassessment1(request, pk):
-    study = get_object_or_404(StudyAnalysis, pk=pk)
+    study = _get_study(pk)
+
+    # 1) Reassess the processed data with the intra-observer probability tables
+    processed_df = _stage(study, "reassessed", "intra")
+    # The final result follows the model the user reassessed with last
+    stages.choose_observer(study, "intra")
 
-    # 1-1) Load probability excel files
-    Intra_PR_Multiple = get_object_or_404(ProbExcelSheets, sheets_name="Intra_PR_Multiple")
-    Intra_PR_Singular = get_object_or_404(ProbExcelSheets, sheets_name="Intra_PR_Singular")
-    Intra_Pro_Multiple = get_object_or_404(ProbExcelSheets, sheets_name="Intra_Pro_Multiple")
-    Intra_Pro_Singular = get_object_or_404(ProbExcelSheets, sheets_name="Intra_Pro_Singular")
-    PR_Multiple = pd.read_excel(Intra_PR_Multiple.imported_sheet, sheetname=0)
-    PR_Singular = pd.read_excel(Intra_PR_Singular.imported_sheet, sheetname=0)
-    Pro_Multiple = pd.read_excel(Intra_Pro_Multiple.imported_sheet, sheetname=0)
-    Pro_Singular = pd.read_excel(Intra_Pro_Singular.imported_sheet, sheetname=0)
-
-    # 1-2) Change the index of probability dataframe
-    def change_index(pd_input):
-        pd_input.loc[:, 'PercentChange'] = np.round(pd_input.loc[:, 'PercentChange'])
-        pd_input.loc[:, 'PercentChange'] = pd_input.loc[:, 'PercentChange'].astype(int)
-        pd_input = pd_input.set_index(['PercentChange'])
-        pd_input.columns = pd_input.columns.astype(str)
-        return pd_input
-    PR_Multiple = change_index(PR_Multiple)
-    PR_Singular = change_index(PR_Singular)
-    Pro_Multiple = change_index(Pro_Multiple)
-    Pro_Singular = change_index(Pro_Singular)
-
-    # 2-1) Prepare the new dataframe about reassessment result (PartialResponse, Progression)
-    processed_df = study.processed_df[['Patient ID', 'Number of solid organ tumors', 'Number of lymph nodes', 'Lesion size at baseline (mm)', 'Percentage change (%)']]
-    processed_df.columns = ['ID', 'NS', 'NL', 'LS', 'PC']
-
-    processed_df.loc[:, 'NS'] = processed_df.loc[:, 'NS'].astype(str)
-    processed_df.loc[:, 'NL'] = processed_df.loc[:, 'NL'].astype(str)
-    processed_df.loc[:, 'LS'] = processed_df.loc[:, 'LS'].astype(str)
-
-    # 2-2) Setting the serial number to each record
-    for record in range(len(processed_df.index)):
-        if processed_df.loc[record, 'LS'] != 'nan':
-            processed_df.loc[record, 'old_status'] = processed_df.loc[record, 'NS'] + processed_df.loc[record, 'NL'] + str(int(float(processed_df.loc[record, 'LS'])))
-        else:
-            processed_df.loc[record, 'old_status'] = processed_df.loc[record, 'NS'] + processed_df.loc[record, 'NL']
-
-    # 2-3) Making [percent change] exceeding 100 to 100
-    for record in range(len(processed_df.index)):
-        if processed_df.loc[record, 'PC'] > 100:
-            processed_df.loc[record, 'PC'] = 100
-
-    # 2-4) Delete [# of Solid tumor & Lymph node] columns and make new columns
-    processed_df = processed_df.drop(processed_df.columns[[1, 2]], axis=1)
-    processed_df.loc[:, 'new_PR'] = processed_df.loc[:, 'new_PRO'] = 0
-
-    # 3) Match the records' serial numbers to the probability-df's data
-    for record in range(len(processed_df.index)):
-        if processed_df.loc[record, 'LS'] == 'nan':  # multiple
-            processed_df.loc[record, 'new_PR'] = PR_Multiple.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
-            processed_df.loc[record, 'new_PRO'] = Pro_Multiple.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
-        else:  # singular
-            processed_df.loc[record, 'new_PR'] = PR_Singular.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
-            processed_df.loc[record, 'new_PRO'] = Pro_Singular.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
-
-    # 4) Save the new dataframe
-    study.reassessed_df = processed_df
-    study.save()
-
-    # 5) Draw a plot for visualizing patients' diagnosis results.
+    # 2) Draw a plot for visualizing patients' diagnosis results.
     new_data = {'Index': [i + 1 for i in range(len(processed_df.index))],
                'Probability of PR (%)': sorted(processed_df.loc[:, "new_PR"], reverse=False)}
     sorted_df = pd.DataFrame(new_data)
@@ -262,7 +250,7 @@ def data_reassessment1(request, pk):
     script_Pro, div_Pro = components(sorted_plot)
 
     # Summarized data (initial waterfall plot)
-    sorted_df = study.sorted_df
+    sorted_df = _stage(study, "sorted")
     sorted_plot = Bar(sorted_df, values='Percentage change (%)', color="White", title='Percentage change (%)', legend=None, ylabel="", ygrid=False)
     sorted_plot.y_range = Range1d(-100, 100)
     sorted_plot.xaxis.visible = False
@@ -314,68 +302,16 @@ def data_reassessment1(request, pk):
 
 
 # Calculate the inter-observer measurement error
+@profiled
 def data_reassessment2(request, pk):
-    study = get_object_or_404(StudyAnalysis, pk=pk)
+    study = _get_study(pk)
+
+    # 1) Reassess the processed data with the inter-observer probability tables
+    processed_df = _stage(study, "reassessed", "inter")
+    # The final result follows the model the user reassessed with last
+    stages.choose_observer(study, "inter")
 
-    Inter_PR_Multiple = get_object_or_404(ProbExcelSheets, sheets_name="Inter_PR_Multiple")
-    Inter_PR_Singular = get_object_or_404(ProbExcelSheets, sheets_name="Inter_PR_Singular")
-    Inter_Pro_Multiple = get_object_or_404(ProbExcelSheets, sheets_name="Inter_Pro_Multiple")
-    Inter_Pro_Singular = get_object_or_404(ProbExcelSheets, sheets_name="Inter_Pro_Singular")
-    PR_Multiple = pd.read_excel(Inter_PR_Multiple.imported_sheet, sheetname=0)
-    PR_Singular = pd.read_excel(Inter_PR_Singular.imported_sheet, sheetname=0)
-    Pro_Multiple = pd.read_excel(Inter_Pro_Multiple.imported_sheet, sheetname=0)
-    Pro_Singular = pd.read_excel(Inter_Pro_Singular.imported_sheet, sheetname=0)
-
-    # 1-2) Change the index of probability dataframe
-    def change_index(pd_input):
-        pd_input.loc[:, 'PercentChange'] = np.round(pd_input.loc[:, 'PercentChange'])
-        pd_input.loc[:, 'PercentChange'] = pd_input.loc[:, 'PercentChange'].astype(int)
-        pd_input = pd_input.set_index(['PercentChange'])
-        pd_input.columns = pd_input.columns.astype(str)
-        return pd_input
-    PR_Multiple = change_index(PR_Multiple)
-    PR_Singular = change_index(PR_Singular)
-    Pro_Multiple = change_index(Pro_Multiple)
-    Pro_Singular = change_index(Pro_Singular)
-
-    # 2-1) Prepare the new dataframe about reassessment result (PartialResponse, Progression)
-    processed_df = study.processed_df[['Patient ID', 'Number of solid organ tumors', 'Number of lymph nodes', 'Lesion size at baseline (mm)', 'Percentage change (%)']]
-    processed_df.columns = ['ID', 'NS', 'NL', 'LS', 'PC']
-
-    processed_df.loc[:, 'NS'] = processed_df.loc[:, 'NS'].astype(str)
-    processed_df.loc[:, 'NL'] = processed_df.loc[:, 'NL'].astype(str)
-    processed_df.loc[:, 'LS'] = processed_df.loc[:, 'LS'].astype(str)
-
-    # 2-2) Setting the serial number to each record
-    for record in range(len(processed_df.index)):
-        if processed_df.loc[record, 'LS'] != 'nan':
-            processed_df.loc[record, 'old_status'] = processed_df.loc[record, 'NS'] + processed_df.loc[record, 'NL'] + str(int(float(processed_df.loc[record, 'LS'])))
-        else:
-            processed_df.loc[record, 'old_status'] = processed_df.loc[record, 'NS'] + processed_df.loc[record, 'NL']
-
-    # 2-3) Making [percent change] exceeding 100 to 100
-    for record in range(len(processed_df.index)):
-        if processed_df.loc[record, 'PC'] > 100:
-            processed_df.loc[record, 'PC'] = 100
-
-    # 2-4) Delete [# of Solid tumor & Lymph node] columns and make new columns
-    processed_df = processed_df.drop(processed_df.columns[[1, 2]], axis=1)
-    processed_df.loc[:, 'new_PR'] = processed_df.loc[:, 'new_PRO'] = 0
-
-    # 3) Match the records' serial numbers to the probability-df's data
-    for record in range(len(processed_df.index)):
-        if processed_df.loc[record, 'LS'] == 'nan':  # multiple
-            processed_df.loc[record, 'new_PR'] = PR_Multiple.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
-            processed_df.loc[record, 'new_PRO'] = Pro_Multiple.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
-        else:  # singular
-            processed_df.loc[record, 'new_PR'] = PR_Singular.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
-            processed_df.loc[record, 'new_PRO'] = Pro_Singular.loc[processed_df.loc[record, 'PC'], processed_df.loc[record, 'old_status']]
-
-    # 4) Save the new dataframe
-    study.reassessed_df = processed_df
-    study.save()
-
-    # 5) Draw a plot for visualizing patients' diagnosis results.
+    # 2) Draw a plot for visualizing patients' diagnosis results.
     new_data = {'Index': [i + 1 for i in range(len(processed_df.index))],
                'Probability of PR (%)': sorted(processed_df.loc[:, "new_PR"], reverse=False)}
     sorted_df = pd.DataFrame(new_data)
@@ -403,7 +339,7 @@ def data_reassessment2(request, pk):
     script_Pro, div_Pro = components(sorted_plot)
 
     # Summarized data (initial waterfall plot)
-    sorted_df = study.sorted_df
+    sorted_df = _stage(study, "sorted")
     sorted_plot = Bar(sorted_df, values='Percentage change (%)', color="White", title='Percentage change (%)', legend=None, ylabel="", ygrid=False)
     sorted_plot.y_range = Range1d(-100, 100)
     sorted_plot.xaxis.visible = False
@@ -454,51 +390,43 @@ def data_reassessment2(request, pk):
     return render(request, "calcmain/reassessment_result.html", context)
 
 
+@profiled
 def final_result(request, pk):
-    study = get_object_or_404(StudyAnalysis, pk=pk)
-    input_df = study.reassessed_df
-
-    # 1) Add rows of UP patients.
-    base_index = len(input_df.index)
-    for i in range(study.up_patients):
-        input_df.loc[base_index + i, "new_PR"] = 0
-        input_df.loc[base_index + i, "new_PRO"] = 1
-
-    # 2) Generate 1000 sets of new variables(1or0) following bernoulli distribution.
-    # Key = Patient ID, Value = Bernoulli random variable
-    bernoulli_dict_PR = {}
-    bernoulli_dict_PR0 = {}
-    # Column = Key = Patients' ID, Row = Value = 1000 Bernoulli random variables derived from patients new_PR or new_PRO proportion
-    for record in range(len(input_df.index)):
-        bernoulli_dict_PR[record] = np.random.choice([0, 1], size=(1000,), p=[1-input_df.loc[record, 'new_PR'], input_df.loc[record, 'new_PR']])
-        bernoulli_dict_PR0[record] = np.random.choice([0, 1], size=(1000,), p=[1-input_df.loc[record, 'new_PRO'], input_df.loc[record, 'new_PRO']])
-        # bernoulli_dict_PR[record] = bernoulli.rvs(input_df.loc[record, 'new_PR'], size=1000)
-        # bernoulli_dict_PR0[record] = bernoulli.rvs(input_df.loc[record, 'new_PRO'], size=1000)
-
-    # 3) Make dataframes of variables and calculate each trials' (rows') means.
-    PR_df = pd.DataFrame(bernoulli_dict_PR)
-    PR_df.loc[:, "NewProb(PR)"] = PR_df.sum(axis=1) / len(PR_df.columns)
-    PRO_df = pd.DataFrame(bernoulli_dict_PR0)
-    PRO_df.loc[:, "NewProb(PRO)"] = PRO_df.sum(axis=1) / len(PRO_df.columns)
-
-    # 4) Make new dataframes with calculated means and find quantile numbers
-    new_data = {'Index': [i + 1 for i in range(len(PR_df.index))],
-               'Probability of PR (%)': sorted((PR_df.loc[:, "NewProb(PR)"] * 100).astype(int), reverse=False)}
-    sorted_PR_df = pd.DataFrame(new_data)
+    study = _get_study(pk)
+    observer = request.GET.get("observer") or stages.current_observer(study)
+    if observer not in pipeline.OBSERVERS:
+        return HttpResponseBadRequest("Unknown observer model.")
+    reassessed_df = _stage(study, "reassessed", observer)
+
+    # 1) Simulate reassessments of every patient, UP patients included, with the
+    # study's seed. A fixed number of trials, or batches until the quantiles are
+    # stable (?adaptive=1). Results are memoized, so reloads give the same numbers.
+    if request.GET.get("adaptive") == "1":
+        try:
+            precision = float(request.GET.get("precision", settings.CALCMAIN_ADAPTIVE_PRECISION))
+        except ValueError:
+            return HttpResponseBadRequest("Invalid precision.")
+        # A precision of 0, a negative one, NaN or infinity is not a precision
+        if not (math.isfinite(precision) and precision > 0):
+            return HttpResponseBadRequest("Precision must be a positive number.")
+        result = simulation.final_distribution(study, reassessed_df, observer, precision=precision)
+    else:
+        result = simulation.final_distribution(study, reassessed_df, observer)
+    pr_rates, pro_rates = result.pr_rates, result.pro_rates
+    num_trials = len(pr_rates)
 
-    quantile_bottom_pr = sorted_PR_df.loc[25, "Probability of PR (%)"] # 26th
-    quantile_top_pr = sorted_PR_df.loc[974, "Probability of PR (%)"] # 975th
-    quantile_median_pr = int((sorted_PR_df.loc[499, "Probability of PR (%)"] + sorted_PR_df.loc[500, "Probability of PR (%)"]) / 2)
+    # 2) Make new dataframes with the trials' rates and find quantile numbers
+    new_data = {'Index': [i + 1 for i in range(num_trials)],
+               'Probability of PR (%)': np.sort(pr_rates)}
+    sorted_PR_df = pd.DataFrame(new_data)
+    quantile_bottom_pr, quantile_median_pr, quantile_top_pr = simulation.central_range(pr_rates)
 
-    new_data = {'Index': [i + 1 for i in range(len(PRO_df.index))],
-               'Probability of PRO (%)': sorted((PRO_df.loc[:, "NewProb(PRO)"] * 100).astype(int), reverse=False)}
+    new_data = {'Index': [i + 1 for i in range(num_trials)],
+               'Probability of PRO (%)': np.sort(pro_rates)}
     sorted_PRO_df = pd.DataFrame(new_data)
+    quantile_bottom_pro, quantile_median_pro, quantile_top_pro = simulation.central_range(pro_rates)
 
-    quantile_bottom_pro = sorted_PRO_df.loc[25, "Probability of PRO (%)"] # 26th
-    quantile_top_pro = sorted_PRO_df.loc[974, "Probability of PRO (%)"] # 975th
-    quantile_median_pro = int((sorted_PRO_df.loc[499, "Probability of PRO (%)"] + sorted_PRO_df.loc[500, "Probability of PRO (%)"]) / 2)
-
-    # 5) Draw histogram plots for visualizing calculation results.
+    # 3) Draw histogram plots for visualizing calculation results.
     # pr_plot = Histogram(sorted_PR_df, values='Probability of PR (%)', bins=7, color='blue', title='', ylabel='', xlabel='') # 15
     pr_plot = Bar(sorted_PR_df, label='Probability of PR (%)', bar_width=1, values="Index", agg="count", color='blue', title='', xlabel='Observed objective response rate', ylabel='Number of obervation', legend=False)
     pr_plot.title.text_font = "Roboto Slab"
@@ -532,14 +460,125 @@ def final_result(request, pk):
         "script_PR": script_PR,
         "div_PR": div_PR,
         "script_Pro": script_Pro,
-        "div_Pro": div_Pro
+        "div_Pro": div_Pro,
+        "num_trials": num_trials,
+        "precision": round(result.error, 2) if result.error is not None else None
     }
     return render(request, "calcmain/final_result.html", context)
 
 
+@profiled
+def data_longitudinal(request, pk):
+    study = _get_study(pk)
+    observer = request.GET.get("observer", "intra")
+    if observer not in pipeline.OBSERVERS:
+        return HttpResponseBadRequest("Unknown observer model.")
+
+    # 1) Burdens and percent changes of every patient at every timepoint, in one grouped pass
+    process_df = precompute.fetch(study, "longitudinal_df")
+    if process_df is None:
+        main_df = pipeline.read_sheet(study)
+        if not pipeline.is_longitudinal(main_df):
+            return redirect('calcmain:data_process', pk=study.pk)
+        try:
+            process_df = pipeline.process_longitudinal(main_df)
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+
+    # 2) Reassessed probabilities of every row with vectorized table lookups
+    reassessed_df = precompute.fetch(study, "reassessed_longitudinal_" + observer, observer=observer)
+    if reassessed_df is None:
+        try:
+            tables = pipeline.load_probability_tables(observer)
+        except ProbExcelSheets.DoesNotExist:
+            raise Http404("Probability tables are not imported.")
+        try:
+            reassessed_df = pipeline.reassess_longitudinal(process_df, tables)
+        except KeyError as error:
+            return HttpResponseBadRequest("No probabilities for (percent change, status) %s." % (error.args[0],))
+
+    # 3) Response rates over time
+    trajectory_df = pipeline.trajectories(reassessed_df, study.up_patients)
+
+    timepoints = [str(timepoint) for timepoint in trajectory_df['Timepoint']]
+    plot = figure(width=600, height=350, title='', x_range=timepoints, y_range=Range1d(0, 100), x_axis_label='Timepoint', y_axis_label='Proportion of patients (%)')
+    for column, color, dash in [('Observed ORR (%)', 'blue', 'solid'),
+                                ('Expected ORR at reassessment (%)', 'blue', 'dashed'),
+                                ('Observed progression rate (%)', 'red', 'solid'),
+                                ('Expected progression rate at reassessment (%)', 'red', 'dashed')]:
+        plot.line(timepoints, trajectory_df[column].tolist(), line_color=color, line_dash=dash, line_width=2, legend=column)
+        plot.circle(timepoints, trajectory_df[column].tolist(), fill_color=color, line_color=color, size=6)
+    plot.legend.location = "top_left"
+    plot.title.text_font = "Roboto Slab"
+    plot.background_fill_alpha = 0
+    plot.border_fill_color = None
+    script, div = components(plot)
+
+    context = {
+        "study": study,
+        "observer": observer,
+        "num_patients": process_df['Patient ID'].nunique(),
+        "num_timepoints": len(trajectory_df.index),
+        "trajectory": trajectory_df.to_html(index=False, classes=["table", "table-hover", "table-processed"]),
+        "script": script,
+        "div": div
+    }
+    return render(request, "calcmain/longitudinal_result.html", context)
+
+
+@profiled
+def compare(request):
+    # ?studies=control_pk,treatment_pk[,treatment_pk...]&observer=intra|inter
+    observer = request.GET.get("observer", "intra")
+    if observer not in pipeline.OBSERVERS:
+        return HttpResponseBadRequest("Unknown observer model.")
+    try:
+        pks = [int(pk) for pk in request.GET.get("studies", "").split(",") if pk]
+    except ValueError:
+        return HttpResponseBadRequest("Invalid study list.")
+    if len(pks) < 2:
+        return HttpResponseBadRequest("Select a control study and at least one treatment study.")
+
+    studies = [_get_study(pk) for pk in pks]
+    arms = []
+    for study in studies:
+        # A comparison only reads the arms, their own wizard results stay as they are
+        reassessed_df = _stage(study, "reassessed", observer, store=False)
+        arms.append(simulation.response_probabilities(reassessed_df, study.up_patients))
+
+    # All arms are simulated in one batched draw, seeded by the control study
+    rng = np.random.RandomState(studies[0].simulation_seed)
+    results = simulation.compare_arms(arms, rng=rng)
+    for study, result in zip(studies[1:], results):
+        result["study"] = study
+
+    context = {
+        "control": studies[0],
+        "observer": pipeline.OBSERVERS[observer],
+        "results": results,
+        "num_trials": settings.CALCMAIN_SIMULATION_TRIALS,
+        "exact_max_patients": settings.CALCMAIN_EXACT_MAX_PATIENTS
+    }
+    return render(request, "calcmain/compare.html", context)
+
+
 def export_delete(request, pk):
     study = get_object_or_404(StudyAnalysis, pk=pk)
-    study.imported_sheet.delete()
+    study.imported_sheet.delete(save=False)
     study.delete()
 
     return render(request, "calcmain/deleted.html", {})
+
+
+@staff_member_required
+def profiles(request):
+    context = {"profiles": profiling.recent_profiles()}
+    name = request.GET.get("name")
+    if name:
+        try:
+            context["functions"], context["total_time"] = profiling.top_functions(name)
+        except ValueError:
+            raise Http404("No such profile.")
+        context["name"] = name
+        context["allocations"] = profiling.top_allocations(name)
+    return render(request, "calcmain/profiles.html", context)
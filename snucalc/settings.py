@@ -133,3 +133,27 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
+
+# Speculative precomputation of the wizard's pipeline right after an upload
+CALCMAIN_PRECOMPUTE = os.getenv('CALCMAIN_PRECOMPUTE') != 'FALSE'
+CALCMAIN_PRECOMPUTE_WORKERS = 2
+CALCMAIN_PRECOMPUTE_WAIT = 30  # seconds a view waits for an in-flight job
+
+# Retention of abandoned studies (manage.py purge_studies)
+CALCMAIN_RETENTION_DAYS = 7
+CALCMAIN_STORAGE_BUDGET_MB = 500
+CALCMAIN_RETENTION_BATCH = 50
+
+# Monte Carlo simulation of the final results
+CALCMAIN_SIMULATION_TRIALS = 1000
+CALCMAIN_ADAPTIVE_PRECISION = 0.5  # standard error of the percentiles, in percentage points
+CALCMAIN_ADAPTIVE_MAX_TRIALS = 20000
+CALCMAIN_ADAPTIVE_BATCH = 200
+CALCMAIN_ADAPTIVE_PRECISION_STEP = 0.1  # requested precisions are rounded to this step
+CALCMAIN_ADAPTIVE_MAX_PRECISION = 5.0  # and capped at this one
+CALCMAIN_EXACT_MAX_PATIENTS = 1000  # larger arms are only compared by simulation
+
+# Per-request profiling for staff users (?_profile=1, or ?_profile=mem for allocations)
+CALCMAIN_PROFILING = True
+CALCMAIN_PROFILE_ROOT = os.path.join(BASE_DIR, 'profiles')
+CALCMAIN_PROFILE_KEEP = 200  # older profiles are deleted